@@ -16,7 +16,7 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
   var mutiny = {
     channel_log: [],
     avatars: {},
-    seen: '0',
+    seen: 0,
     dom: dom,
 
     retry: 1,
@@ -24,6 +24,14 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
     max_retry_timeout: 8,
     refresh: 90,
     running: 0,
+    source: null,
+    streaming: false,
+    use_stream: true,
+    socket: null,
+    socket_open: false,
+    use_socket: true,
+    pending: {},
+    request_id: 0,
 
     trim_log: function() {
       /* FIXME: If log has grown too long, play nice and delete some events. */
@@ -65,8 +73,8 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
                        .replace(/mutiny_avatar=/g, 'src="'+avatar+'" x='))
     },
 
-    render_time: function(iid, template) {
-      var dt = new Date(parseInt(iid.substring(0, iid.indexOf('-')))*1000);
+    render_time: function(ts, template) {
+      var dt = new Date(ts*1000);
       var mm = (' 0'+dt.getMinutes());
       var hh = (' 0'+dt.getHours());
       return template.replace(/_HH_MM_/g,
@@ -83,7 +91,13 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
         data = [];
       }
       setTimeout(global+'.load_data('+refresh+');', delay);
+      mutiny.render_events(data);
+    },
 
+    render_events: function(data) {
+      if ((data.length > 0) && data[0][1].event == 'pleasejoin') {
+        data = [];
+      }
       for (idx in data) {
         mutiny.channel_log.push(data[idx]);
         var iid = data[idx][0];
@@ -129,7 +143,7 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
           dom.find('#'+info.target).remove();
         }
         else if (tpl) {
-          tpl = mutiny.render_time(dom_id,
+          tpl = mutiny.render_time(data[idx][2],
                   mutiny.render_nick(info.nick || '', info.uid || '',
                     mutiny.render_text(/_UID_/g, info.uid,
                       mutiny.render_text(/_STAT_/g, info.stat,
@@ -195,8 +209,96 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
       return null;
     },
 
+    connect: function() {
+      /* One WebSocket carries events to us, and what we say to them. */
+      var url = mutiny_api_url+'?a=ws&seen='+mutiny.seen;
+      if (url.indexOf('http') == 0) {
+        url = url.replace(/^http/, 'ws');
+      }
+      else {
+        url = ((document.location.protocol == 'https:') ? 'wss://' : 'ws://')
+              + document.location.host + url;
+      }
+      var socket = mutiny.socket = new WebSocket(url);
+      socket.onopen = function() {
+        mutiny.socket_open = true;
+        mutiny.retry = 1;
+        dom.find('#disconnected').hide();
+      };
+      socket.onmessage = function(e) {
+        var data = JSON.parse(e.data);
+        if (data.length === undefined) {
+          var callback = mutiny.pending[data.id];
+          delete mutiny.pending[data.id];
+          if (callback) callback(data);
+        }
+        else {
+          mutiny.render_events(data);
+          if ((data.length > 0) && data[0][1].event == 'pleasejoin') {
+            mutiny.retry = 5;
+          }
+        }
+      };
+      socket.onclose = function() {
+        var worked = mutiny.socket_open;
+        mutiny.socket = null;
+        mutiny.socket_open = false;
+        for (var id in mutiny.pending) {
+          mutiny.pending[id]({'ok': false});
+        }
+        mutiny.pending = {};
+        if (!worked) {
+          /* Never worked: fall back to streaming or long-polling. */
+          mutiny.use_socket = false;
+          mutiny.load_data(0);
+        }
+        else {
+          setTimeout(global+'.load_data(0);', 1000 * mutiny.retry);
+          mutiny.retry = Math.min(mutiny.retry * 2, mutiny.max_retry_timeout);
+        }
+      };
+    },
+
+    send: function(request, callback) {
+      /* Send a request over the WebSocket, returns false if we cannot. */
+      if (!mutiny.socket_open) return false;
+      request.id = ++mutiny.request_id;
+      mutiny.pending[request.id] = callback;
+      mutiny.socket.send(JSON.stringify(request));
+      return true;
+    },
+
+    stream: function() {
+      /* One long-lived connection, the server pushes events to us. */
+      var source = mutiny.source = new EventSource(
+        mutiny_api_url+'?a=stream&seen='+mutiny.seen);
+      source.onmessage = function(e) {
+        mutiny.streaming = true;
+        dom.find('#disconnected').hide();
+        mutiny.render_events(JSON.parse(e.data));
+      };
+      source.onerror = function(e) {
+        if (!mutiny.streaming || source.readyState == EventSource.CLOSED) {
+          /* Never worked or gave up: fall back to long-polling. */
+          source.close();
+          mutiny.source = null;
+          mutiny.use_stream = mutiny.streaming;
+          mutiny.streaming = false;
+          mutiny.load_data(0);
+        }
+      };
+    },
+
     load_data: function(timeout) {
-      if (mutiny.running > 0) return;
+      if (mutiny.socket || mutiny.source || mutiny.running > 0) return;
+      if (mutiny.use_socket && window.WebSocket && window.JSON) {
+        mutiny.connect();
+        return;
+      }
+      if (mutiny.use_stream && window.EventSource) {
+        mutiny.stream();
+        return;
+      }
       mutiny.running += 1;
       $.ajax({
         url: mutiny_api_url,
@@ -274,7 +376,17 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
       var message = input.attr('value');
 
       dom.find('form#input').removeClass('error').addClass('sending');
-      $.ajax({
+      var sent = mutiny.send({'a': 'say', 'msg': message}, function(data) {
+        if (data.ok) {
+          dom.find('form#input').removeClass('error').removeClass('sending');
+        }
+        else {
+          alert('Oops, sending failed!');
+          input.attr('value', message + ' ' + input.attr('value'));
+          dom.find('form#input').addClass('error').removeClass('sending');
+        }
+      });
+      if (!sent) $.ajax({
         url: mutiny_api_url,
         timeout: 10 * 1000,
         dataType: 'json',
@@ -284,7 +396,14 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
           'msg': message,
         },
         success: function(data) {
-          dom.find('form#input').removeClass('error').removeClass('sending');
+          if (data[0] == 'ok') {
+            dom.find('form#input').removeClass('error').removeClass('sending');
+          }
+          else {
+            alert('Oops, sending failed!');
+            input.attr('value', message + ' ' + input.attr('value'));
+            dom.find('form#input').addClass('error').removeClass('sending');
+          }
         },
         error: function(jqXHR, stat, errThrown) {
           alert('Oops, sending failed!');
@@ -298,7 +417,11 @@ function Mutiny(mutiny_host, mutiny_network, mutiny_uids, mutiny_channel,
     },
 
     logout: function() {
-      $.ajax({
+      var sent = mutiny.send({'a': 'logout'}, function(data) {
+        document.cookie = 'muid-'+mutiny_network+'=; Path=/; Max-Age=0';
+        mutiny.render([]);
+      });
+      if (!sent) $.ajax({
         url: mutiny_api_url,
         timeout: 10 * 1000,
         dataType: 'json',
@@ -24,10 +24,14 @@ VERSION = 'v0.1'
 ################################################################################
 #
 # Python standard
+import hashlib
+import hmac
+import json
 import os
 import random
+import re
+import signal
 import sys
-import threading
 import time
 import traceback
 import urllib
@@ -36,8 +40,12 @@ import zlib
 import sockschain
 import HttpdLite
 # Stuff from Mutiny
-from mutiny.io import SelectLoop, SelectAborted, Connect
-from mutiny.irc import IrcClient, IrcBot, get_timed_uid
+from mutiny.io import SelectLoop, Connect, Future
+from mutiny.irc import IrcClient, IrcBot, json_entry
+from mutiny.httpd import Server, HttpConnection, EventStream, WebSocket, Asset
+from mutiny.httpd import etag_matches
+from mutiny.journal import Journal
+from mutiny.search import Tokenizer
 
 
 DEFAULT_PATH = os.path.expanduser('~/.mutiny')
@@ -53,29 +61,122 @@ def html_escape(text):
   """Produce entities within text."""
   return "".join(html_escape_table.get(c,c) for c in text)
 
+def js_string(text):
+  """Produce a quoted JavaScript string, safe within <script> tags."""
+  return (json.dumps(text.decode('utf-8', 'replace'))
+          .replace('<', '\\u003c').replace('>', '\\u003e')
+          .replace('&', '\\u0026'))
+
 
 class NotFoundException(Exception):
   """Thrown when we want to render a 404."""
   pass
 
 class AccessDeniedException(Exception):
-  """Thrown when we want to render a 401."""
+  """Thrown when we want to render a 403."""
   pass
 
 
+class TemplateVars(dict):
+  """Template variables, %(skin:NAME)s expands to the URL of an asset."""
+
+  def __init__(self, mutiny, *args, **kwargs):
+    dict.__init__(self, *args, **kwargs)
+    self.mutiny = mutiny
+
+  def __missing__(self, key):
+    if key.startswith('skin:'):
+      return self.mutiny.skin_url(key[5:], config=self)
+    raise KeyError(key)
+
+
+class CompiledTemplate:
+  """A template split into UTF-8 chunks and %(name)s slots, once.
+
+  Values are HTML-escaped, except for RAW ones. Within scripts, use
+  %(js:name)s instead, which expands to a quoted JavaScript string."""
+
+  SLOT_RE = re.compile(r'%(?:\(([^)]+)\)s|%)')
+
+  # Variables which hold HTML, everything else is escaped.
+  RAW = ('linked_channel_list', )
+
+  def __init__(self, source):
+    self.chunks = []
+    self.slots = []
+    static, pos = [], 0
+    for m in self.SLOT_RE.finditer(source):
+      static.append(source[pos:m.start()])
+      pos = m.end()
+      if m.group(1) is None:
+        static.append('%')
+      else:
+        self.chunks.append(''.join(static))
+        self.slots.append(m.group(1))
+        static = []
+    static.append(source[pos:])
+    self.chunks.append(''.join(static))
+
+  def values(self, page):
+    values = []
+    for slot in self.slots:
+      escape = html_escape
+      if slot.startswith('js:'):
+        slot, escape = slot[3:], js_string
+      elif slot in self.RAW:
+        escape = None
+      value = page[slot]
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      elif not isinstance(value, str):
+        value = str(value)
+      if escape is not None:
+        value = escape(value)
+      values.append(value)
+    return tuple(values)
+
+  def render(self, values):
+    output = [self.chunks[0]]
+    for i, value in enumerate(values):
+      output.append(value)
+      output.append(self.chunks[i+1])
+    return ''.join(output)
+
+
 class Mutiny():
   """The main Mutiny class."""
 
+  # Reconnect backoff: doubles with every failure, within these bounds.
+  RECONNECT_MIN = 2
+  RECONNECT_MAX = 300
+  # Connections which survive this long reset the backoff.
+  RECONNECT_STABLE = 120
+  # Users who are not seen for this long are logged out.
+  SESSION_TTL = 1800
+  SESSION_REAP = 60
+
   def __init__(self, config):
     self.work_dir = config['work_dir']
     self.listen_on = (config['http_host'], int(config['http_port']))
     self.config = config
 
-    self.event_loop = SelectLoop()
+    self.event_loop = SelectLoop(poller=config.get('poller'))
     self.DEBUG = self.event_loop.DEBUG = self.config.get('debug', False)
 
     self.config_irc = config['irc']
     self.networks = {}
+    self.journal = None
+    self.journaled = {}
+    self.auth_handler = None
+    self.session_secret = os.urandom(20)
+    self.sessions = {}
+    self.template_cache = {}
+    self.asset_cache = {}
+    self.compiled_templates = {}
+    self.render_cache = {}
+    self.config_generation = 0
+    self.channel_list = (None, None)
+    self.index_cache = {}
 
   def parse_spec(self, server):
     if ':' in server:
@@ -92,41 +193,300 @@ class Mutiny():
   def start(self):
     if not os.path.exists(self.work_dir):
       os.mkdir(self.work_dir)
+    if self.config.get('journal'):
+      self.journal = Journal(os.path.join(self.work_dir, 'logs'),
+                             Tokenizer(self.TRANSLATE))
+      self.journal.start()
+    self.configure_oauth2()
     for network, settings in self.config['irc'].iteritems():
       if settings['enable']:
-        bot = self.networks[network] = IrcBot()
-        bot.irc_nickname(settings['nickname'])
-        bot.irc_channels(settings['channels'].keys())
-        self.connect_client(network, bot)
+        self.start_network(network, settings)
+    self.event_loop.call_every(self.SESSION_REAP, self.reap_sessions)
     self.event_loop.start()
 
+  def start_network(self, network, settings):
+    bot = self.networks[network] = IrcBot()
+    bot.irc_event_loop(self.event_loop)
+    bot.irc_nickname(settings['nickname'])
+    bot.irc_channels(settings['channels'].keys())
+    for channel, ch_settings in settings['channels'].iteritems():
+      if 'maxlines' in ch_settings:
+        bot.irc_maxlines(channel, ch_settings['maxlines'])
+      if self.is_journaled(network, channel):
+        self.start_journal(network, bot, channel)
+    # Connect once the logs are restored, so new entries continue them.
+    self.after_journal(self.reconnect_now, network, bot)
+
+  def stop_network(self, network):
+    """Disconnect the bot and all users, they will not reconnect."""
+    bot = self.networks.pop(network)
+    for channel in bot.channels:
+      self.stop_journal(network, bot, channel)
+    for client in bot.users.values():
+      self.end_session(client)
+    for client in [bot] + bot.users.values():
+      self.cancel_reconnect(client)
+      self.send_to(client, 'QUIT :Network disabled\r\n')
+
+  def send_to(self, client, data):
+    """Send to a client, if it is connected."""
+    sockfd = self.event_loop.fds_by_uid.get(client.uid)
+    if sockfd is None:
+      return False
+    self.event_loop.sendall(sockfd, data)
+    return True
+
+  def session_sig(self, network, uid):
+    return hmac.new(self.session_secret, '%s/%s' % (network, uid),
+                    hashlib.sha1).hexdigest()[:20]
+
+  def start_session(self, network, client):
+    """Create a signed session token for a user's client."""
+    client.session = '%s.%s' % (client.uid, self.session_sig(network,
+                                                             client.uid))
+    self.sessions[client.session] = (network, client)
+    return client.session
+
+  def session_user(self, network, token):
+    """Return the client for a session token, or None."""
+    try:
+      network, token = str(network), str(token)
+    except UnicodeError:
+      return None
+    uid, sig = (token.split('.', 1) + [''])[:2]
+    if not hmac.compare_digest(sig, self.session_sig(network, uid)):
+      return None
+    session = self.sessions.get(token)
+    if session is None or session[0] != network:
+      return None
+    return session[1]
+
+  def end_session(self, client):
+    self.sessions.pop(getattr(client, 'session', None), None)
+
+  def reap_sessions(self):
+    """Log out users who have not been seen for SESSION_TTL seconds."""
+    idle = time.time() - self.SESSION_TTL
+    for network, client in self.sessions.values():
+      if client.seen < idle:
+        print 'Idle, logging out: %s' % client.nickname
+        self.logout(network, client)
+
+  def configure_oauth2(self):
+    if self.auth_handler is None:
+      return
+    auth_cfg = self.config.get('oauth2', {})
+    for provider in auth_cfg:
+      if provider in self.auth_handler.oauth2:
+        self.auth_handler.oauth2[provider].update(auth_cfg[provider])
+      else:
+        self.auth_handler.oauth2[provider] = auth_cfg[provider]
+
+  def reload(self, config=None):
+    """Apply a new configuration, keeping existing connections open.
+
+    This must run on the event loop thread."""
+    config = config or Configuration()
+    for setting in ('work_dir', 'http_host', 'http_port', 'poller',
+                    'journal'):
+      if config.get(setting) != self.config.get(setting):
+        print 'Reload: changing %s requires a restart' % setting
+        config[setting] = self.config.get(setting)
+
+    old_irc, new_irc = self.config_irc, config['irc']
+    self.config = config
+    self.config_irc = new_irc
+    self.DEBUG = self.event_loop.DEBUG = config.get('debug', False)
+
+    for network in sorted(set(old_irc.keys()) | set(new_irc.keys())):
+      settings = new_irc.get(network, {})
+      if network in self.networks and not settings.get('enable'):
+        print 'Reload: stopping %s' % network
+        self.stop_network(network)
+      elif network not in self.networks and settings.get('enable'):
+        print 'Reload: starting %s' % network
+        self.start_network(network, settings)
+      elif network in self.networks:
+        self.update_network(network, old_irc[network], settings)
+
+    self.configure_oauth2()
+    self.config_changed()
+
+  def update_network(self, network, old_settings, settings):
+    """Change nick, JOIN and PART channels to match the new settings."""
+    bot = self.networks[network]
+    if settings['nickname'] != old_settings.get('nickname'):
+      # If connected, on_nick records the change once the server agrees.
+      if not self.send_to(bot, 'NICK %s\r\n' % settings['nickname']):
+        bot.irc_nickname(settings['nickname'])
+
+    old_channels = set(bot.channels)
+    new_channels = set(str(c) for c in settings['channels'])
+    bot.irc_channels(settings['channels'].keys())
+    for channel in sorted(old_channels - new_channels):
+      print 'Reload: leaving %s on %s' % (channel, network)
+      self.send_to(bot, 'PART %s\r\n' % channel)
+      for client in bot.users.values():
+        if channel in client.channels:
+          client.channels.remove(channel)
+          self.send_to(client, 'PART %s\r\n' % channel)
+      self.stop_journal(network, bot, channel)
+
+    for channel, ch_settings in settings['channels'].iteritems():
+      maxlines = ch_settings.get('maxlines')
+      if (maxlines is not None and
+          int(maxlines) != bot.maxlines.get(channel)):
+        bot.irc_maxlines(channel, maxlines)
+      if self.is_journaled(network, channel):
+        self.start_journal(network, bot, channel)
+      else:
+        self.stop_journal(network, bot, channel)
+
+    for channel in sorted(new_channels - old_channels):
+      print 'Reload: joining %s on %s' % (channel, network)
+      self.after_journal(self.send_to, bot, 'JOIN %s\r\n' % channel)
+
+  def is_journaled(self, network, channel):
+    ch_settings = self.config_irc[network]['channels'].get(channel, {})
+    return bool(self.journal and ch_settings.get('log', True))
+
+  def is_recording(self, network, channel):
+    """Is the journal recording this channel (as opposed to configured to)?"""
+    return (network, channel) in self.journaled
+
+  def start_journal(self, network, bot, channel):
+    """Restore the channel log from disk and record everything new.
+
+    Opening a journal means reading from disk, so the journal thread
+    does that and the log is restored back on the event loop. A log
+    which is already live is only journaled if its numbering is ahead
+    of the journal's, as the journal ignores entries it thinks it has."""
+    key = (network, channel)
+    if key in self.journaled:
+      return
+    log = bot.irc_channel_log(channel)
+    count = len(log.slots)
+    def record(channel, seq):
+      ts = log[-1][2]
+      for seq, line in log.json_entries_after(seq - 1):
+        self.journal.append(network, channel, seq, ts, line)
+    def restore(lines, last_seq):
+      if self.journaled.get(key) is not record:
+        return
+      if log.next_seq == 1:
+        bot.irc_restore_log(channel, lines, last_seq)
+      elif log.next_seq <= last_seq:
+        print ('Journal for %s on %s ends at %d, but the live log is at %d.'
+               ' Not journaling until restart.'
+               ) % (channel, network, last_seq, log.next_seq - 1)
+        del self.journaled[key]
+        return
+      bot.irc_subscribe(channel, record)
+    def open_journal():
+      cj = self.journal.channel(network, channel)
+      self.event_loop.call_soon(restore, cj.tail(count), cj.last_seq)
+    self.journaled[key] = record
+    self.journal.call(open_journal)
+
+  def stop_journal(self, network, bot, channel):
+    record = self.journaled.pop((network, channel), None)
+    if record is not None:
+      bot.irc_unsubscribe(channel, record)
+
+  def after_journal(self, callback, *args):
+    """Run callback(*args) on the loop once pending journal work is done."""
+    if self.journal is None:
+      callback(*args)
+    else:
+      # The journal thread works in order, so this is scheduled after
+      # anything start_journal queued before us.
+      self.journal.call(self.event_loop.call_soon, callback, *args)
+
   def connect_client(self, network, client, server_spec=None):
     if not server_spec:
-      server_spec = self.config['irc'][network]['servers'][0]
+      servers = self.config['irc'][network]['servers']
+      server_spec = servers[client.server_index % len(servers)]
     proto, server, port = self.parse_spec(server_spec)
     print 'Connecting to %-15s %s://%s:%d/' % (network, proto, server, port)
     client.server = server
-    Connect(proto, server, port, *self.callbacks(network, client)).start()
+    Connect(self.event_loop, proto, server, port,
+            *self.callbacks(network, client)).start()
 
   def stop(self):
     self.event_loop.stop()
+    if self.journal:
+      self.journal.stop()
 
-  def failed(self, network, bot, socket):
-    # FIXME: This is rather dumb, we should retry.
-    self.stop()
-    raise
+  def failed(self, network, bot):
+    print 'Failed to connect to %s!' % (network)
+    self.reconnect(network, bot)
 
   def callbacks(self, network, bot):
     def ok(sockfd):
       return self.connected(network, bot, sockfd)
-    def fail(sockfd):
-      return self.failed(network, bot, sockfd)
+    def fail():
+      return self.failed(network, bot)
     return ok, fail
 
   def connected(self, network, bot, sockfd):
     print 'Connected to %s!' % (network)
+    bot.connected_at = time.time()
+    self.event_loop.add(sockfd, bot, lambda: self.disconnected(network, bot))
     bot.process_connect(lambda d: self.event_loop.sendall(sockfd, d))
-    self.event_loop.add(sockfd, bot)
+
+  def disconnected(self, network, bot):
+    print 'Disconnected from %s!' % (network)
+    bot.process_disconnect()
+    if time.time() - bot.connected_at > self.RECONNECT_STABLE:
+      bot.connect_failures = 0
+    self.reconnect(network, bot)
+
+  def is_supervised(self, network, client):
+    """Is this client still one we want to keep connected?"""
+    if not self.event_loop.keep_running or network not in self.networks:
+      return False
+    bot = self.networks[network]
+    return (client is bot or client.uid in bot.users)
+
+  def reconnect(self, network, client):
+    """Retry with jittered exponential backoff, rotating through servers."""
+    if not self.is_supervised(network, client):
+      return
+    delay = min(self.RECONNECT_MAX,
+                self.RECONNECT_MIN * 2 ** min(client.connect_failures, 16))
+    delay *= random.uniform(0.5, 1.0)
+    client.connect_failures += 1
+    client.server_index += 1
+    print 'Reconnecting to %s in %d seconds' % (network, delay)
+    client.reconnect_timer = self.event_loop.call_later(delay,
+                                                        self.reconnect_now,
+                                                        network, client)
+
+  def reconnect_now(self, network, client):
+    client.reconnect_timer = None
+    # The user may have logged out or the network stopped meanwhile.
+    if self.is_supervised(network, client):
+      self.connect_client(network, client)
+
+  def cancel_reconnect(self, client):
+    if client.reconnect_timer is not None:
+      self.event_loop.cancel(client.reconnect_timer)
+      client.reconnect_timer = None
+
+  # How often cached templates are checked against the filesystem
+  TEMPLATE_RECHECK = 10
+  TEMPLATE_CACHE_MAX = 1000
+
+  def template_stamp(self, candidates):
+    """Find the first candidate file which exists, and its mtime."""
+    for fp in candidates:
+      try:
+        return fp, os.stat(fp).st_mtime
+      except OSError:
+        # Files bundled into the script exist, but cannot be stat()ed.
+        if os.path.exists(fp):
+          return fp, None
+    return None, None
 
   def load_template(self, name, config={}, max_size=102400):
     sv = {}
@@ -136,37 +496,128 @@ class Mutiny():
       sv[setting] = [config.get(setting, self.config.get(setting, default))]
       if default not in sv[setting]:
         sv[setting].append(default)
-    tried = []
-    for path in sv['templates']:
-      for skin in sv['skin']:
-        for lang in sv['lang']:
-          fp = os.path.join(path, os.path.join(skin, os.path.join(lang, name)))
-          tried.append(fp)
-          if os.path.exists(fp):
-            fd = open(fp, 'rb')
-            return open(fp).read(max_size)
-    raise NotFoundException('Not found: %s, tried: %s' % (name, tried))
+    key = (tuple(sv['templates']), tuple(sv['skin']), tuple(sv['lang']), name)
+
+    # Cached templates (and misses) are trusted for TEMPLATE_RECHECK
+    # seconds, then only re-read if a different file or mtime is found.
+    now = time.time()
+    cached = self.template_cache.get(key)
+    if cached is None or cached[0] < now:
+      candidates = []
+      for path in sv['templates']:
+        for skin in sv['skin']:
+          for lang in sv['lang']:
+            candidates.append(os.path.join(path, os.path.join(skin,
+                                                    os.path.join(lang, name))))
+      stamp = self.template_stamp(candidates)
+      if cached is None or cached[1] != stamp:
+        data = None
+        if stamp[0]:
+          fd = open(stamp[0], 'rb')
+          try:
+            data = fd.read(max_size)
+          finally:
+            fd.close()
+        cached = (now + self.TEMPLATE_RECHECK, stamp, data, candidates)
+      else:
+        cached = (now + self.TEMPLATE_RECHECK, ) + cached[1:]
+      if len(self.template_cache) >= self.TEMPLATE_CACHE_MAX:
+        # Misses are cached too, do not let random URLs fill memory.
+        self.template_cache = {}
+      self.template_cache[key] = cached
+
+    if cached[2] is None:
+      raise NotFoundException('Not found: %s, tried: %s' % (name, cached[3]))
+    return cached[2]
+
+  def load_asset(self, name, config={}):
+    """Return a static Asset, compressed and hashed the first time."""
+    data = self.load_template(name, config=config)
+    key = (config.get('templates'), config.get('skin'), name)
+    asset = self.asset_cache.get(key)
+    if asset is None or asset.source is not data:
+      mime_type = HttpdLite.GuessMimeType(name)
+      asset = Asset(data, mime_type, gzipped=(
+        mime_type != 'application/octet-stream' and name.endswith('.gz')))
+      if len(self.asset_cache) >= self.TEMPLATE_CACHE_MAX:
+        self.asset_cache = {}
+      self.asset_cache[key] = asset
+    return asset
+
+  def render_template(self, template, page):
+    """Render a template, or return None if it is not one.
+
+    Templates are compiled once per source, and finished pages are
+    cached by their (escaped) values, so identical pages are only
+    built once. Per-user pages get entries of their own."""
+    compiled = self.compiled_templates.get(template, False)
+    if compiled is False:
+      compiled = None
+      if '__Mutiny_Template__' in template:
+        compiled = CompiledTemplate(template)
+      if len(self.compiled_templates) >= self.TEMPLATE_CACHE_MAX:
+        self.compiled_templates = {}
+      self.compiled_templates[template] = compiled
+    if compiled is None:
+      return None
+
+    key = (compiled, compiled.values(page))
+    data = self.render_cache.get(key)
+    if data is None:
+      data = compiled.render(key[1])
+      if len(self.render_cache) >= self.TEMPLATE_CACHE_MAX:
+        self.render_cache = {}
+      self.render_cache[key] = data
+    return data
+
+  def skin_url(self, name, config={}):
+    """Return a fingerprinted URL, which may be cached forever."""
+    try:
+      return '/_skin/%s/%s' % (self.load_asset(name, config).digest, name)
+    except NotFoundException:
+      return '/_skin/%s' % name
 
   def fixup_channel(self, channel):
     if not channel[0] in ('!', '&'):
       channel = '#' + channel
     return channel
 
+  def config_changed(self):
+    """Forget anything rendered from the old configuration."""
+    self.config_generation += 1
+    self.template_cache = {}
+    self.asset_cache = {}
+    self.index_cache = {}
+    self.render_cache = {}
+
   def renderChannelList(self):
+    generation, html = self.channel_list
+    if generation != self.config_generation:
+      generation = self.config_generation
+      html = self.renderChannelListHtml()
+      self.channel_list = (generation, html)
+    return html
+
+  def renderChannelListHtml(self):
+    """Render the channel list, which the templates include unescaped."""
+    def quote(text):
+      if isinstance(text, unicode):
+        text = text.encode('utf-8')
+      return urllib.quote(text, '')
     html = []
     networks = sorted([(n, self.config_irc[n])
                        for n in self.config_irc
                              if self.config_irc[n]['enable']])
     for net_id, network in networks:
       if len(networks) > 1:
-        html.append('<li class="network">%s<ul>' % network.get('description',
-                                                               net_id))
+        html.append('<li class="network">%s<ul>' % html_escape(
+                                    network.get('description', net_id)))
       channels = network['channels']
       for ch_id, channel in sorted([(i, c) for i, c in channels.items()]):
         if 'unlisted' not in channel.get('access', 'open'):
           html.append(('<li><a href="/join/%s/%s">%s</a></li>'
-                       ) % (net_id, ch_id.replace('#', ''),
-                            channel.get('description', ch_id)))
+                       ) % (quote(net_id), quote(ch_id.replace('#', '')),
+                            html_escape(channel.get('description', ch_id))))
       if len(networks) > 1:
         html.append('</ul></li>')
     if html:
@@ -195,19 +646,18 @@ class Mutiny():
     for c, v in cookies.items():
       try:
         prefix, network = c.split('-', 1)
-        muid = v.value.split(',')[0]
-        if (not network in self.networks or
-            muid not in self.networks[network].users):
+        if prefix != 'muid':
+          continue
+        token, log_id = (v.value.split(',', 1) + [''])[:2]
+        user = self.session_user(network, token)
+        if user is None:
           req.setCookie(c, '', delete=True)
+        elif log_id != user.log_id:
+          req.setCookie(c, '%s,%s' % (token, user.log_id))
         else:
-          log_id = v.value.split(',', 1)[1]
-          user = self.networks[network].users[muid]
-          if log_id != user.log_id:
-            req.setCookie(c, '%s,%s' % (muid, user.log_id))
-          else:
-            user.seen = time.time()
-            credentials[network] = user
-      except (ValueError, KeyError):
+          user.seen = time.time()
+          credentials[network] = user
+      except ValueError:
         pass
 
     # Shared values for rendering templates
@@ -215,24 +665,21 @@ class Mutiny():
     page_prefix = '/'.join(page_url.split('/', 4)[:3])
     host = req.header('Host', 'unknown').lower()
     template = ''
-    page = {
+    page = TemplateVars(self, {
       'templates': os.path.join(self.work_dir, 'html'),
       'version': VERSION,
       'skin': host,
       'host': host,
       'page_path': '/'+path_url,
       'page_url': page_url,
-    }
+    })
 
     # Get the actual content.
     try:
       if req.command == 'GET':
 
         if path == '':
-          template = self.load_template('index.html', config=page)
-          page.update({
-            'linked_channel_list': self.renderChannelList()
-          })
+          return self.sendIndexPage(req, page, headers)
 
         elif path.startswith('_api/v1/'):
           return self.handleApiRequest(req, path, qs, posted)
@@ -242,10 +689,11 @@ class Mutiny():
 
         elif (path.startswith('_skin/') or
               path in ('favicon.ico', )):
-          template = self.load_template(path.split('/')[-1], config=page)
-          mime_type = HttpdLite.GuessMimeType(path)
-          if mime_type != 'application/octet-stream' and path.endswith('.gz'):
-            headers.append(('Content-Encoding', 'gzip'))
+          parts = path.split('/')
+          asset = self.load_asset(parts[-1], config=page)
+          if len(parts) == 3 and parts[1] == asset.digest:
+            cachectrl = 'max-age=31536000, public, immutable'
+          return asset.respond(req, headers, cachectrl)
 
         elif path.startswith('_authlite/') and req.auth_info:
           return self.handleUserLogin(req, page_prefix, path, qs)
@@ -260,15 +708,19 @@ class Mutiny():
       elif req.command == 'POST':
         if path.startswith('_api/v1/'):
           return self.handleApiRequest(req, path, qs, posted)
+        elif path == '_admin/reload':
+          return self.handleAdminReload(req, posted)
         else:
           raise NotFoundException()
 
     except NotFoundException:
       cachectrl, code, data = 'no-cache', 404, '<h1>404 Not found</h1>\n'
+    except AccessDeniedException:
+      cachectrl, code, data = 'no-cache', 403, '<h1>403 Access denied</h1>\n'
 
     if not data:
-      if '__Mutiny_Template__' in template:
-        data = (template.decode('utf-8') % page).encode('utf-8')
+      data = self.render_template(template, page)
+      if data is not None:
         cachectrl = 'no-cache'
       else:
         data = template
@@ -276,6 +728,52 @@ class Mutiny():
                             code=code, mimetype=mime_type,
                             header_list=headers, cachectrl=cachectrl)
 
+  def sendIndexPage(self, req, page, headers):
+    """Serve the front page, which only changes with the configuration."""
+    template = self.load_template('index.html', config=page)
+    key = (self.config_generation, page['page_url'])
+    cached = self.index_cache.get(key)
+    if cached is None or cached[0] is not template:
+      page.update({
+        'linked_channel_list': self.renderChannelList()
+      })
+      data = self.render_template(template, page)
+      if data is None:
+        data = template
+      cached = (template, data, '"%s"' % hashlib.sha1(data).hexdigest()[:16])
+      if len(self.index_cache) >= self.TEMPLATE_CACHE_MAX:
+        self.index_cache = {}
+      self.index_cache[key] = cached
+
+    template, data, etag = cached
+    headers = headers + [('ETag', etag)]
+    if etag_matches(req, etag):
+      return req.sendResponse('', code=304, msg='Not Modified',
+                              length=len(data),
+                              header_list=headers, cachectrl='no-cache')
+    return req.sendResponse(data, header_list=headers, cachectrl='no-cache')
+
+  def handleAdminReload(self, req, posted):
+    """Reload the configuration, if the admin_key matches."""
+    admin_key = self.config.get('admin_key')
+    if not admin_key:
+      raise NotFoundException()
+    key = (posted or {}).get('key', [''])[0]
+    if not hmac.compare_digest(str(key), str(admin_key)):
+      raise AccessDeniedException()
+
+    response = Future()
+    def reload():
+      try:
+        self.reload()
+        response.set_result(HttpdLite.json_encode(['ok']))
+      except (ValueError, KeyError, OSError, IOError), e:
+        print '%s' % traceback.format_exc()
+        response.set_result(HttpdLite.json_encode(['error', str(e)]))
+    self.event_loop.call_soon(reload)
+    return HttpConnection(self.event_loop, req).send_later(response,
+                          mimetype='application/json', cachectrl='no-cache')
+
   def get_channel_from_path(self, path):
     join, network, channel = path.split('/')
     if join != 'join':
@@ -348,8 +846,9 @@ class Mutiny():
     self.networks[network].users[client.uid] = client
     self.connect_client(network, client)
 
-    # Finally, set a cookie with their client's UID.
-    req.setCookie('muid-%s' % network, '%s,pending' % client.uid)
+    # Finally, set a cookie with their signed session token.
+    req.setCookie('muid-%s' % network,
+                  '%s,pending' % self.start_session(network, client))
 
     print 'Logged in: %s' % HttpdLite.json_encode(profile, indent=2)
     return req.sendRedirect(page_prefix + state)
@@ -362,9 +861,10 @@ class Mutiny():
       uids = 'anon'
       if network in credentials:
         user = credentials[network]
-        uids = '%s,%s' % (user.uid, user.log_id)
+        uids = '%s,%s' % (user.session, user.log_id)
 
       info = nw_channels[channel]
+      logging = self.is_recording(network, channel)
       page.update({
         'network': network,
         'network_desc': self.config_irc[network].get('description', network),
@@ -374,8 +874,8 @@ class Mutiny():
         'channel_desc': info.get('description', channel),
         'channel_access': info.get('access', 'open').replace(',', ' '),
         'logged_in': 'no',
-        'log_status': 'off',
-        'log_not': 'not ',
+        'log_status': logging and 'on' or 'off',
+        'log_not': (not logging) and 'not ' or '',
         'log_url': '/',
       })
       template = self.load_template('channel.html', config=page)
@@ -394,85 +894,282 @@ class Mutiny():
     if muid == 'anon':
       user = None
     else:
-      user = self.networks[network].users[muid.split(',')[0]]
+      user = self.session_user(network, muid.split(',')[0])
+      if user is None:
+        raise AccessDeniedException()
     headers = self.CORS_HEADERS[:]
     method = (posted or qs).get('a', qs.get('a'))[0]
     mime_type, data = getattr(self, 'api_%s' % method
                               )(network, user, self.fixup_channel(channel),
                                 req, qs, posted)
+    if isinstance(data, Future):
+      # Long-polls do not park a thread, the event loop answers them.
+      return HttpConnection(self.event_loop, req).send_later(data,
+                            mimetype=mime_type,
+                            header_list=headers, cachectrl='no-cache')
+    if isinstance(data, HttpConnection):
+      # Streams take care of their own responses.
+      return None
     return req.sendResponse(data,
                             mimetype=mime_type,
                             header_list=headers, cachectrl='no-cache')
 
+  def pleasejoin(self, bot, user, channel):
+    """Return a pleasejoin event if the user may not read the channel."""
+    mode = bot.irc_channel_mode(channel)
+    if mode.requires_join and not (user and channel in user.channels):
+      # This will hide the channel key and other parameters
+      return '[%s]' % json_entry([0, mode.hidden, int(time.time())])
+    return None
+
   def api_log(self, network, user, channel, req, qs, posted):
     # FIXME: Choose between bots based on network
     grep = qs.get('grep', [''])[0]
     after = qs.get('seen', [None])[0]
+    before = qs.get('before', [None])[0]
     limit = int(qs.get('limit', [0])[0])
     timeout = int(qs.get('timeout', [0])[0])
     if timeout:
       timeout += time.time()
 
     bot = self.networks[network]
-    rules = bot.irc_parsed_mode(channel)
-    if (rules.get('secret', False) or
-        rules.get('key', False) or
-        rules.get('invite_only', False)):
-      if not (user and channel in user['channels']):
-        # This will hide the channel key and other parameters
-        for r in rules:
-          if rules[r]:
-            rules[r] = True
-        rules['event'] = 'pleasejoin'
-        return 'application/json', HttpdLite.json_encode([
-          [get_timed_uid(), rules]
-        ])
-
-    data = []
+    pleasejoin = self.pleasejoin(bot, user, channel)
+    if pleasejoin:
+      return 'application/json', pleasejoin
+
+    if grep:
+      match = lambda info: (grep in info.get('nick', '').lower() or
+                            grep in info.get('text', ''))
+    else:
+      match = None
+
+    if before or self.is_archived(network, bot, channel, after):
+      return 'application/json', self.history(network, bot, channel,
+                                              after, before, limit, match)
+
+    def get_data():
+      return bot.irc_channel_log(channel).json_after(after, limit, match)
+
+    data = get_data()
+    if data != '[]' or not timeout:
+      return 'application/json', data
+
+    # Nothing to report yet: answer when the log changes or we time out.
+    response = Future()
+    waiters = []
+    def cleanup(ignored=None):
+      for waiter in waiters:
+        bot.irc_unwatch_channel(channel, waiter)
+    def check(ignored=None):
+      if response.done():
+        return
+      # Watch before looking, so nothing slips in between.
+      cleanup()
+      waiter = Future()
+      waiters[:] = [waiter]
+      bot.irc_watch_channel(channel, waiter)
+      data = get_data()
+      if data != '[]' or time.time() >= timeout:
+        response.set_result(data)
+      else:
+        waiter.add_done_callback(check)
+    timer = self.event_loop.call_at(timeout, check)
+    response.add_done_callback(lambda r: self.event_loop.cancel(timer))
+    response.add_done_callback(cleanup)
+    # Watchers are only ever touched on the loop thread.
+    self.event_loop.call_soon(check)
+    return 'application/json', response
+
+  HISTORY_PAGE = 100
+
+  def is_archived(self, network, bot, channel, after):
+    """Is the cursor older than anything still in memory?"""
     try:
-      while not data:
-        data = bot.irc_channel_log(channel)
-        if after or grep:
-          data = [x for x in data if (x[0] > after) and
-                                     (not grep or
-                                      grep in x[1]['nick'].lower() or
-                                      grep in x[1].get('text', ''))]
-        if timeout and not data:
-          cond = threading.Condition()
-          ev = self.event_loop.add_sleeper(timeout, cond, 'API request')
-          bot.irc_watch_channel(channel, ev)
-          cond.acquire()
-          cond.wait()
-          cond.release()
-          self.event_loop.remove_sleeper(ev)
-        if time.time() >= timeout:
-          break
-    except SelectAborted:
-      pass
+      after = int(after)
+    except (TypeError, ValueError):
+      return False
+    log = bot.irc_channel_log(channel)
+    return (after > 0 and after + 1 < log.next_seq - len(log) and
+            self.is_recording(network, channel))
+
+  def history(self, network, bot, channel, after, before, limit, match):
+    """Return a page of entries, reading older ones from the journal.
+
+    The page covers up to limit entries after (or before) the cursor,
+    so a filtered page may come back short. It only comes back empty
+    if nothing matches all the way to the end (or start) of the log,
+    as an empty page tells the client there is nothing more to fetch."""
+    limit = min(limit or self.HISTORY_PAGE, self.HISTORY_PAGE)
+    try:
+      if before:
+        last = int(before) - 1
+        first = max(1, last - limit + 1)
+      else:
+        first = int(after) + 1
+        last = first + limit - 1
+    except ValueError:
+      return '[]'
+    lines = self.history_lines(network, bot, channel, first, last, match)
+    end = bot.irc_channel_log(channel).next_seq - 1
+    while match is not None and not lines:
+      if before and first > 1:
+        last = first - 1
+        first = max(1, last - self.HISTORY_PAGE + 1)
+        lines = self.history_lines(network, bot, channel, first, last,
+                                   match)[-limit:]
+      elif not before and last < end:
+        first = last + 1
+        last = first + self.HISTORY_PAGE - 1
+        lines = self.history_lines(network, bot, channel, first, last,
+                                   match)[:limit]
+      else:
+        break
+    return '[%s]' % ','.join(lines)
+
+  def history_lines(self, network, bot, channel, first, last, match=None):
+    """Return entries first to last as JSON, from memory or journal."""
+    log = bot.irc_channel_log(channel)
+    in_memory = log.next_seq - len(log)
+
+    line_match = lambda line: (match is None or
+                               match(HttpdLite.json_decode(line)[1]))
+    lines = []
+    if first < in_memory and self.is_recording(network, channel):
+      lines = self.journal.channel(network, channel).read(
+        first, min(last, in_memory - 1), line_match)
+    if last >= in_memory:
+      lines.extend(line for seq, line
+                   in log.json_entries_after(max(first, in_memory) - 1)
+                   if seq <= last and line_match(line))
+    return lines
+
+  def api_search(self, network, user, channel, req, qs, posted):
+    query = qs.get('q', [''])[0].decode('utf-8')
+    limit = min(int(qs.get('limit', [20])[0]), self.HISTORY_PAGE)
+    offset = int(qs.get('offset', [0])[0])
 
-    if limit:
-      data = data[-limit:]
+    bot = self.networks[network]
+    pleasejoin = self.pleasejoin(bot, user, channel)
+    if pleasejoin:
+      return 'application/json', pleasejoin
+    if not self.is_recording(network, channel):
+      return 'application/json', '[]'
+
+    # Hits are [score, entry], best first. The entry's seq is a cursor
+    # for fetching context with the log API's seen= or before=.
+    index = self.journal.channel(network, channel).search
+    if index is None:
+      # Still catching up with the journal.
+      return 'application/json', '[]'
+    hits = []
+    for score, seq in index.search(query, limit, offset):
+      for line in self.history_lines(network, bot, channel, seq, seq):
+        hits.append('[%.3f,%s]' % (score, line))
+    return 'application/json', '[%s]' % ','.join(hits)
+
+  def subscribe(self, bot, channel, conn, seen, send):
+    """Feed new log entries to send(body, seq) until conn is closed."""
+    cursor = [seen]
+    def send_new(ignored=None, seq=None):
+      entries = bot.irc_channel_log(channel).json_entries_after(cursor[0])
+      if entries:
+        cursor[0] = entries[-1][0]
+        send('[%s]' % ','.join(e[1] for e in entries), cursor[0])
+    def start():
+      if not conn.closed:
+        bot.irc_subscribe(channel, send_new)
+        send_new()
+    conn.on_close(lambda: bot.irc_unsubscribe(channel, send_new))
+    self.event_loop.call_soon(start)
+
+  def api_stream(self, network, user, channel, req, qs, posted):
+    """Stream the channel log as Server-Sent Events."""
+    bot = self.networks[network]
+    stream = EventStream(self.event_loop, req, header_list=self.CORS_HEADERS)
+    pleasejoin = self.pleasejoin(bot, user, channel)
+    if pleasejoin:
+      stream.send_event(pleasejoin, retry=5000)
+      stream.close()
+    else:
+      self.keep_alive(user, stream)
+      self.subscribe(bot, channel, stream,
+                     req.header('Last-Event-ID') or qs.get('seen', [None])[0],
+                     lambda body, seq: stream.send_event(body, event_id=seq))
+    return 'text/event-stream', stream
+
+  def api_ws(self, network, user, channel, req, qs, posted):
+    """Log events, say and logout, multiplexed over a WebSocket."""
+    if not WebSocket.is_upgrade(req):
+      raise NotFoundException()
+    bot = self.networks[network]
 
-    return 'application/json', HttpdLite.json_encode(data)
+    def on_message(message):
+      try:
+        request = HttpdLite.json_decode(message)
+        action = request.get('a')
+      except (ValueError, AttributeError):
+        return ws.close(1003)
+      reply = {'a': action, 'id': request.get('id'), 'ok': False}
+      try:
+        if user and user.uid in bot.users:
+          if action == 'say':
+            reply['ok'] = self.say(user, channel, request['msg'])
+          elif action == 'logout':
+            self.logout(network, user)
+            reply['ok'] = True
+      except KeyError:
+        # Not connected yet, or a malformed request.
+        pass
+      ws.send_text(HttpdLite.json_encode(reply))
+      if action == 'logout':
+        ws.close()
+
+    ws = WebSocket(self.event_loop, req, on_message)
+    pleasejoin = self.pleasejoin(bot, user, channel)
+    if pleasejoin:
+      ws.send_text(pleasejoin)
+      ws.close()
+    else:
+      self.keep_alive(user, ws)
+      self.subscribe(bot, channel, ws, qs.get('seen', [None])[0],
+                     lambda body, seq: ws.send_text(body))
+    return 'application/json', ws
+
+  def logout(self, network, user):
+    self.end_session(user)
+    self.cancel_reconnect(user)
+    if network in self.networks:
+      self.networks[network].users.pop(user.uid, None)
+    self.send_to(user, 'QUIT :Logged off\r\n')
+
+  def keep_alive(self, user, conn):
+    """Keep a user logged in for as long as a stream is open."""
+    def touch():
+      user.seen = time.time()
+    if user:
+      conn.on_heartbeat(touch)
+
+  def say(self, user, channel, message):
+    """Send a message, returns False if the user is not connected."""
+    privmsg = ''.join(['PRIVMSG %s :%s\r\n' % (channel, line)
+                       for line in message.splitlines() if line.strip()])
+    return self.send_to(user, privmsg.encode('utf-8'))
 
   def api_logout(self, network, user, channel, req, qs, posted):
-    del self.networks[network].users[user.uid]
+    self.logout(network, user)
     req.setCookie('muid-%s' % network, '', delete=True)
-
-    sockfd = self.event_loop.fds_by_uid[user.uid]
-    self.event_loop.sendall(sockfd, 'QUIT :Logged off\r\n')
     return 'application/json', HttpdLite.json_encode(['ok'])
 
   def api_say(self, network, user, channel, req, qs, posted):
-    sockfd = self.event_loop.fds_by_uid[user.uid]
-    privmsg = 'PRIVMSG %s :%s\r\n' % (channel,
-                                      posted['msg'][0].decode('utf-8'))
-    self.event_loop.sendall(sockfd, privmsg.encode('utf-8'))
+    if not self.say(user, channel, posted['msg'][0].decode('utf-8')):
+      return 'application/json', HttpdLite.json_encode(['error',
+                                                        'Not connected'])
     return 'application/json', HttpdLite.json_encode(['ok'])
 
-
 def Configuration():
-  if '--version' in sys.argv:
+  # Work on a copy of the arguments, so the config can be reloaded.
+  argv = sys.argv[:]
+  if '--version' in argv:
     print '%s' % VERSION
     sys.exit(0)
 
@@ -483,6 +1180,9 @@ def Configuration():
     'lang': 'en',
     'skin': 'default',
     'debug': False,
+    'poller': 'auto',
+    'journal': True,
+    'admin_key': None,
     'irc': {},
     # These are ignored, but picked up by sockschain
     'nossl': None,
@@ -491,20 +1191,22 @@ def Configuration():
 
   # Set work dir before loading config, all other command-line arguments
   # will override the config file.
-  for arg in sys.argv[1:]:
+  for arg in argv[1:]:
     if arg.startswith('--work_dir='):
       config['work_dir'] = arg.split('=', 1)[1]
 
   try:
     fd = open(os.path.join(config['work_dir'], 'config.json'), 'rb')
-    config.update(HttpdLite.json_decode(fd.read()))
+    try:
+      config.update(HttpdLite.json_decode(fd.read()))
+    finally:
+      fd.close()
   except ValueError, e:
-    print 'Failed to parse config: %s' % e
-    sys.exit(1)
+    raise ValueError('Failed to parse config: %s' % e)
   except (OSError, IOError):
     pass
 
-  for arg in sys.argv[1:]:
+  for arg in argv[1:]:
     if arg.startswith('--'):
       found = None
       for var in config:
@@ -514,7 +1216,7 @@ def Configuration():
           found = config[var] = True
       if found is None:
         raise ValueError('Unknown arg: %s' % arg)
-      sys.argv.remove(arg)
+      argv.remove(arg)
 
   if config['debug']:
     def dbg(text):
@@ -522,22 +1224,22 @@ def Configuration():
     sockschain.DEBUG = dbg
 
   nickname = server = channels = None
-  if len(sys.argv) > 1:
+  if len(argv) > 1:
     config['irc']['irc'] = {
       'enable': 1,
-      'nickname': sys.argv.pop(1).replace(' ', '_'),
+      'nickname': argv.pop(1).replace(' ', '_'),
       'userinfo': 'Mutiny %s' % VERSION
     }
-  if len(sys.argv) > 1:
-    arg = sys.argv.pop(1)
+  if len(argv) > 1:
+    arg = argv.pop(1)
     config['irc']['irc']['servers'] = [
       arg.rsplit('/', 1)[0]
     ]
     config['irc']['irc']['channels'] = channels = {}
     for channel in arg.rsplit('/', 1)[1].split(',', 1):
       channels[channel] = {'description': 'IRC channel', 'access': 'open'}
-  if len(sys.argv) > 1:
-    arg = sys.argv.pop(1)
+  if len(argv) > 1:
+    arg = argv.pop(1)
     for channel in channels:
       channels[channel]['access'] = arg
 
@@ -562,17 +1264,14 @@ if __name__ == "__main__":
       print 'Fork me on Github: https://github.com/pagekite/plugins-pyMutiny'
       print
 
-      auth_handler = HttpdLite.AuthHandler()
-      auth_cfg = mutiny.config.get('oauth2', {})
-      for provider in auth_cfg:
-        if provider in auth_handler.oauth2:
-          auth_handler.oauth2[provider].update(auth_cfg[provider])
-        else:
-          auth_handler.oauth2[provider] = auth_cfg[provider]
+      mutiny.auth_handler = HttpdLite.AuthHandler()
+      if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+                          mutiny.event_loop.call_from_signal(mutiny.reload))
 
       mutiny.start()
-      HttpdLite.Server(mutiny.listen_on, mutiny,
-                       auth_handler=auth_handler).serve_forever()
+      Server(mutiny.listen_on, mutiny,
+             auth_handler=mutiny.auth_handler).serve_forever()
     except KeyboardInterrupt:
       mutiny.stop()
   except:
@@ -0,0 +1,401 @@
+#!/usr/bin/python
+#
+# Mutiny.py, Copyright 2012, Bjarni R. Einarsson <http://bre.klaki.net/>
+#
+# This is an IRC-to-WWW gateway designed to help Pirates have Meetings.
+#
+################################################################################
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the  GNU  Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,  but  WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see: <http://www.gnu.org/licenses/>
+#
+################################################################################
+#
+# Python standard
+import base64
+import hashlib
+import struct
+import threading
+import traceback
+import zlib
+from array import array
+try:
+  import brotli
+except ImportError:
+  brotli = None
+# Stuff from PageKite
+import HttpdLite
+# Stuff from Mutiny
+from mutiny.irc import get_unique_id
+
+
+def etag_matches(req, etag):
+  """Does the request's If-None-Match header match the ETag?"""
+  # If-None-Match uses weak comparison, so ignore any W/ prefixes.
+  tags = [t.strip().replace('W/', '', 1)
+          for t in (req.header('If-None-Match') or '').split(',')]
+  return ('*' in tags or etag in tags)
+
+
+class Server(HttpdLite.Server):
+  """An HttpdLite server which can hand connections over to the loop."""
+
+  def __init__(self, *args, **kwargs):
+    HttpdLite.Server.__init__(self, *args, **kwargs)
+    self.detached = set()
+    self.detached_lock = threading.Lock()
+
+  def detach(self, req):
+    """Take over the request's socket, HttpdLite will not close it."""
+    req.wfile.flush()
+    req.close_connection = 1
+    self.detached_lock.acquire()
+    self.detached.add(req.connection)
+    self.detached_lock.release()
+    return req.connection
+
+  def shutdown_request(self, request):
+    self.detached_lock.acquire()
+    try:
+      if request in self.detached:
+        self.detached.remove(request)
+        return
+    finally:
+      self.detached_lock.release()
+    HttpdLite.Server.shutdown_request(self, request)
+
+
+class HttpConnection:
+  """An HTTP connection which is served by the event loop, not a thread."""
+
+  def __init__(self, event_loop, req):
+    self.uid = get_unique_id()
+    self.event_loop = event_loop
+    self.req = req
+    self.pending_headers = req.pending_headers[:]
+    self.futures = []
+    self.closed = False
+    self.sock = req.server.detach(req)
+    self.sock.setblocking(0)
+    event_loop.add(self.sock, self, self.process_disconnect)
+
+  def process_data(self, data, write_cb):
+    """We expect nothing more from the client."""
+
+  def process_disconnect(self):
+    """The loop dropped us: the client left or the response was sent."""
+    self.closed = True
+    for future in self.futures:
+      future.cancel()
+
+  def format_headers(self, code, msg, mimetype, header_list, cachectrl,
+                           length=None):
+    if mimetype.startswith('text/') and ';' not in mimetype:
+      mimetype += '; charset=utf-8'
+    headers = ['HTTP/1.1 %s %s' % (code, msg)]
+    if length is not None:
+      headers.append('Content-Length: %d' % length)
+    headers.extend('%s: %s' % h for h in self.pending_headers)
+    headers.append('Cache-Control: %s' % cachectrl)
+    headers.append('Content-Type: %s' % mimetype)
+    headers.extend('%s: %s' % h for h in header_list)
+    headers.extend(['', ''])
+    return '\r\n'.join(headers)
+
+  def send_response(self, message, code=200, msg='OK', mimetype='text/html',
+                          header_list=[], cachectrl='private'):
+    """Like HttpdLite's sendResponse, but written by the event loop."""
+    if self.closed:
+      return
+    self.req.log_request(code, len(message))
+    self.event_loop.sendall(self.sock, self.format_headers(code, msg,
+                                                           mimetype,
+                                                           header_list,
+                                                           cachectrl,
+                                                           len(message))
+                                       + message)
+    self.close()
+
+  def close(self):
+    """Close the connection once everything queued has been sent."""
+    self.closed = True
+    self.event_loop.close(self.sock)
+
+  def abort(self):
+    """Drop the connection and anything still queued for it."""
+    self.closed = True
+    if self.sock in self.event_loop.conns_by_fd:
+      self.event_loop.remove_fd(self.sock)
+    self.sock.close()
+
+  def send_later(self, future, **kwargs):
+    """Send the future's result as the response, once it is available."""
+    def respond(future):
+      if not future.cancelled():
+        self.send_response(future.result(), **kwargs)
+    self.futures.append(future)
+    future.add_done_callback(respond)
+
+
+class PersistentConnection(HttpConnection):
+  """An HTTP connection which stays open after the response headers."""
+
+  HEARTBEAT = 25
+
+  def __init__(self, event_loop, req):
+    HttpConnection.__init__(self, event_loop, req)
+    self.close_callbacks = []
+    self.heartbeat_callbacks = []
+    self.heartbeat = event_loop.call_every(self.HEARTBEAT, self.beat)
+
+  def process_disconnect(self):
+    HttpConnection.process_disconnect(self)
+    self.event_loop.cancel(self.heartbeat)
+    for callback in self.close_callbacks:
+      try:
+        callback()
+      except:
+        print '%s' % traceback.format_exc()
+
+  def on_close(self, callback):
+    self.close_callbacks.append(callback)
+
+  def on_heartbeat(self, callback):
+    self.heartbeat_callbacks.append(callback)
+
+  def beat(self):
+    self.send_heartbeat()
+    for callback in self.heartbeat_callbacks:
+      try:
+        callback()
+      except:
+        print '%s' % traceback.format_exc()
+
+  def send_heartbeat(self):
+    """Keep proxies from timing out an idle connection."""
+
+  def send_data(self, data):
+    """Queue data, dropping clients which cannot keep up."""
+    if self.closed:
+      return False
+    if not self.event_loop.sendall(self.sock, data):
+      self.abort()
+      return False
+    return True
+
+
+class EventStream(PersistentConnection):
+  """A text/event-stream (Server-Sent Events) response, left open."""
+
+  def __init__(self, event_loop, req, header_list=[]):
+    PersistentConnection.__init__(self, event_loop, req)
+    self.req.log_request(200, '-')
+    self.send_data(self.format_headers(200, 'OK', 'text/event-stream',
+                                       header_list, 'no-cache'))
+
+  def send_heartbeat(self):
+    self.send_data(':\n\n')
+
+  def send_event(self, data, event_id=None, event=None, retry=None):
+    frame = []
+    if event_id is not None:
+      frame.append('id: %s' % event_id)
+    if event:
+      frame.append('event: %s' % event)
+    if retry:
+      frame.append('retry: %d' % retry)
+    frame.extend('data: %s' % line for line in data.split('\n'))
+    frame.extend(['', ''])
+    return self.send_data('\n'.join(frame))
+
+
+class WebSocket(PersistentConnection):
+  """A WebSocket (RFC 6455) connection, served by the event loop."""
+
+  GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+  MAX_MESSAGE = 64 * 1024
+
+  OP_CONTINUATION = 0x0
+  OP_TEXT = 0x1
+  OP_BINARY = 0x2
+  OP_CLOSE = 0x8
+  OP_PING = 0x9
+  OP_PONG = 0xA
+
+  def __init__(self, event_loop, req, on_message, header_list=[]):
+    PersistentConnection.__init__(self, event_loop, req)
+    self.on_message = on_message
+    self.inbuf = ''
+    self.fragments = []
+    self.fragment_bytes = 0
+
+    key = req.header('Sec-WebSocket-Key').strip()
+    accept = base64.b64encode(hashlib.sha1(key + self.GUID).digest())
+    headers = ['HTTP/1.1 101 Switching Protocols',
+               'Upgrade: websocket',
+               'Connection: Upgrade',
+               'Sec-WebSocket-Accept: %s' % accept]
+    headers.extend('%s: %s' % h for h in self.pending_headers + header_list)
+    headers.extend(['', ''])
+    self.req.log_request(101, '-')
+    self.send_data('\r\n'.join(headers))
+
+  def is_upgrade(req):
+    return ((req.header('Upgrade') or '').lower() == 'websocket' and
+            req.header('Sec-WebSocket-Key') and
+            req.header('Sec-WebSocket-Version') == '13')
+  is_upgrade = staticmethod(is_upgrade)
+
+  def unmask(self, mask, data):
+    data, mask = array('B', data), array('B', mask)
+    for i in xrange(len(data)):
+      data[i] ^= mask[i & 3]
+    return data.tostring()
+
+  def process_data(self, data, write_cb):
+    """Parse frames from the client, which must all be masked."""
+    self.inbuf += data
+    while len(self.inbuf) >= 2 and not self.closed:
+      b0, b1 = ord(self.inbuf[0]), ord(self.inbuf[1])
+      fin, opcode, masked, length = b0 & 0x80, b0 & 0x0f, b1 & 0x80, b1 & 0x7f
+      pos = 2
+      if length == 126:
+        if len(self.inbuf) < 4:
+          return
+        length, pos = struct.unpack('>H', self.inbuf[2:4])[0], 4
+      elif length == 127:
+        if len(self.inbuf) < 10:
+          return
+        length, pos = struct.unpack('>Q', self.inbuf[2:10])[0], 10
+      if not masked:
+        return self.close(1002)
+      if length + self.fragment_bytes > self.MAX_MESSAGE:
+        return self.close(1009)
+      if len(self.inbuf) < pos + 4 + length:
+        return
+      payload = self.unmask(self.inbuf[pos:pos+4],
+                            self.inbuf[pos+4:pos+4+length])
+      self.inbuf = self.inbuf[pos+4+length:]
+      self.process_frame(fin, opcode, payload)
+
+  def process_frame(self, fin, opcode, payload):
+    if opcode == self.OP_CLOSE:
+      self.close()
+    elif opcode == self.OP_PING:
+      self.send_frame(self.OP_PONG, payload)
+    elif opcode == self.OP_PONG:
+      pass
+    elif opcode in (self.OP_TEXT, self.OP_BINARY, self.OP_CONTINUATION):
+      self.fragments.append(payload)
+      self.fragment_bytes += len(payload)
+      if fin:
+        message = ''.join(self.fragments)
+        self.fragments, self.fragment_bytes = [], 0
+        try:
+          self.on_message(message)
+        except:
+          print '%s' % traceback.format_exc()
+    else:
+      self.close(1002)
+
+  def send_frame(self, opcode, payload):
+    length = len(payload)
+    if length < 126:
+      header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+      header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+      header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    return self.send_data(header + payload)
+
+  def send_heartbeat(self):
+    self.send_frame(self.OP_PING, '')
+
+  def send_text(self, text):
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    return self.send_frame(self.OP_TEXT, text)
+
+  def close(self, code=1000):
+    """Say goodbye with a close frame, then close the connection."""
+    if not self.closed:
+      self.send_frame(self.OP_CLOSE, struct.pack('>H', code))
+      HttpConnection.close(self)
+
+
+class Asset:
+  """A static file, compressed once and served with strong ETags."""
+
+  COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                  'application/x-javascript', 'image/svg+xml',
+                  'image/x-icon', 'image/vnd.microsoft.icon')
+  PREFERENCE = ('br', 'gzip', 'identity')
+
+  def __init__(self, data, mimetype, gzipped=False):
+    self.source = data
+    self.mimetype = mimetype
+    if gzipped:
+      self.bodies = {'gzip': data, 'identity': zlib.decompress(data, 31)}
+    else:
+      self.bodies = {'identity': data}
+    identity = self.bodies['identity']
+    self.digest = hashlib.sha1(identity).hexdigest()[:16]
+
+    self.compressible = gzipped or mimetype.startswith(self.COMPRESSIBLE)
+    if self.compressible:
+      if 'gzip' not in self.bodies:
+        gz = zlib.compressobj(9, zlib.DEFLATED, 31)
+        self.bodies['gzip'] = gz.compress(identity) + gz.flush()
+      if brotli is not None:
+        self.bodies['br'] = brotli.compress(identity)
+      for coding in self.bodies.keys():
+        if len(self.bodies[coding]) >= len(identity):
+          del self.bodies[coding]
+      self.bodies['identity'] = identity
+    self.etags = dict((c, '"%s%s"' % (self.digest,
+                                      (c != 'identity') and '-'+c or ''))
+                      for c in self.bodies)
+
+  def negotiate(self, accept_encoding):
+    """Pick the preferred encoding the client accepts."""
+    accepted = {}
+    for part in (accept_encoding or '').lower().split(','):
+      coding, params = (part.split(';', 1) + [''])[:2]
+      q = 1.0
+      if params.strip().startswith('q='):
+        try:
+          q = float(params.strip()[2:])
+        except ValueError:
+          pass
+      accepted[coding.strip()] = q
+    for coding in self.PREFERENCE:
+      if coding in self.bodies and accepted.get(coding,
+                                                accepted.get('*', 0)) > 0:
+        return coding
+    return 'identity'
+
+  def respond(self, req, header_list=[], cachectrl='max-age=3600, public'):
+    coding = self.negotiate(req.header('Accept-Encoding'))
+    body = self.bodies[coding]
+    headers = header_list + [('ETag', self.etags[coding])]
+    if self.compressible:
+      headers.append(('Vary', 'Accept-Encoding'))
+    if coding != 'identity':
+      headers.append(('Content-Encoding', coding))
+
+    if etag_matches(req, self.etags[coding]):
+      return req.sendResponse('', code=304, msg='Not Modified',
+                              mimetype=self.mimetype, length=len(body),
+                              header_list=headers, cachectrl=cachectrl)
+    return req.sendResponse(body, mimetype=self.mimetype,
+                            header_list=headers, cachectrl=cachectrl)
@@ -22,11 +22,22 @@
 ################################################################################
 #
 # Python standard
+import collections
 import errno
+import fcntl
+import heapq
+import itertools
+import os
 import select
 import socket
 import threading
 import time
+import traceback
+import Queue
+try:
+  import ssl
+except ImportError:
+  ssl = None
 # Stuff from PageKite
 import sockschain
 from sockschain import SSL
@@ -36,6 +47,167 @@ class SelectAborted(Exception):
   pass
 
 
+class SelectPoller:
+  """Fallback poller using select.select, limited by FD_SETSIZE."""
+
+  def __init__(self):
+    self.readers = {}
+    self.writers = {}
+
+  def register(self, fileno):
+    self.readers[fileno] = True
+
+  def modify(self, fileno, readable=True, writable=False):
+    for fds, want in ((self.readers, readable), (self.writers, writable)):
+      if want:
+        fds[fileno] = True
+      else:
+        fds.pop(fileno, None)
+
+  def unregister(self, fileno):
+    self.readers.pop(fileno, None)
+    self.writers.pop(fileno, None)
+
+  def poll(self, timeout):
+    r, w, x = select.select(self.readers.keys(), self.writers.keys(), [],
+                            timeout)
+    w = set(w)
+    return ([(fileno, True, fileno in w) for fileno in r] +
+            [(fileno, False, True) for fileno in w.difference(r)])
+
+
+class PollPoller:
+  """Poller using poll(2), with persistent fd registration."""
+
+  IN = select.POLLIN | select.POLLPRI
+  OUT = select.POLLOUT
+  ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+  def __init__(self):
+    self.poller = select.poll()
+
+  def register(self, fileno):
+    self.poller.register(fileno, self.IN)
+
+  def modify(self, fileno, readable=True, writable=False):
+    self.poller.modify(fileno, (readable and self.IN or 0) |
+                               (writable and self.OUT or 0))
+
+  def unregister(self, fileno):
+    try:
+      self.poller.unregister(fileno)
+    except KeyError:
+      pass
+
+  def poll(self, timeout):
+    if timeout is not None:
+      timeout = int(timeout * 1000 + 0.999)
+    return [(fileno, bool(ev & (self.IN | self.ERR)), bool(ev & self.OUT))
+            for fileno, ev in self.poller.poll(timeout)]
+
+
+class EpollPoller(PollPoller):
+  """Poller using Linux epoll, cost scales with ready fds only."""
+
+  IN = select.EPOLLIN | select.EPOLLPRI
+  OUT = select.EPOLLOUT
+  ERR = select.EPOLLERR | select.EPOLLHUP
+
+  def __init__(self):
+    self.poller = select.epoll()
+
+  def unregister(self, fileno):
+    try:
+      self.poller.unregister(fileno)
+    except (IOError, OSError, ValueError):
+      pass
+
+  def poll(self, timeout):
+    if timeout is None:
+      timeout = -1
+    return [(fileno, bool(ev & (self.IN | self.ERR)), bool(ev & self.OUT))
+            for fileno, ev in self.poller.poll(timeout)]
+
+
+POLLERS = [('epoll', EpollPoller), ('poll', PollPoller),
+           ('select', SelectPoller)]
+
+def get_poller(name=None):
+  """Return a poller instance, preferring the most efficient available."""
+  for poller, cls in POLLERS:
+    if name in (None, 'auto', poller) and hasattr(select, poller):
+      return cls()
+  raise ValueError('Unsupported poller: %s' % name)
+
+
+class Timer:
+  """A call scheduled on a SelectLoop, see SelectLoop.call_later()."""
+
+  def __init__(self, when, interval, callback, args):
+    self.when = when
+    self.interval = interval
+    self.callback = callback
+    self.args = args
+    self.pending = False
+    self.cancelled = False
+
+
+class Future:
+  """A result which will become available later, on any thread."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.callbacks = []
+    self.value = None
+    self.finished = False
+    self.was_cancelled = False
+
+  def done(self):
+    return self.finished
+
+  def cancelled(self):
+    return self.was_cancelled
+
+  def result(self):
+    return self.value
+
+  def add_done_callback(self, callback):
+    """Call callback(future) once resolved, right away if already done."""
+    self.lock.acquire()
+    try:
+      if not self.finished:
+        self.callbacks.append(callback)
+        return
+    finally:
+      self.lock.release()
+    callback(self)
+
+  def resolve(self, value, cancelled=False):
+    self.lock.acquire()
+    try:
+      if self.finished:
+        return False
+      self.finished = True
+      self.value = value
+      self.was_cancelled = cancelled
+      callbacks, self.callbacks = self.callbacks, []
+    finally:
+      self.lock.release()
+    for callback in callbacks:
+      try:
+        callback(self)
+      except:
+        print '%s' % traceback.format_exc()
+    return True
+
+  def set_result(self, value):
+    """Resolve the future, returns False if it was already resolved."""
+    return self.resolve(value)
+
+  def cancel(self):
+    return self.resolve(None, cancelled=True)
+
+
 class SelectLoop(threading.Thread):
   """This class implements a select loop in a thread of its own."""
 
@@ -44,45 +216,222 @@ class SelectLoop(threading.Thread):
                      errno.EDEADLK, errno.EWOULDBLOCK, errno.ENOBUFS,
                      errno.EALREADY)
 
-  def __init__(self):
+  # Stop reading from a connection while this much output is queued for
+  # it, resume once the queue drains below the low watermark.
+  HIGH_WATERMARK = 256*1024
+  LOW_WATERMARK = 64*1024
+
+  def __init__(self, poller=None):
     threading.Thread.__init__(self)
     self.keep_running = True
+    self.poller = get_poller(poller)
     self.conns_by_fd = {}
+    self.eof_callbacks = {}
     self.fds_by_uid = {}
-    self.sleepers = []
+    self.fds_by_fileno = {}
+    self.filenos_by_fd = {}
+    self.sleepers = {}
+
+    # Outgoing data is queued per connection and drained by the loop.
+    self.outbufs = {}
+    self.outbytes = {}
+    self.interest = {}
+    self.paused = set()
+    self.want_read = set()
+    self.closing = set()
+    self.pending_writes = set()
+    self.write_lock = threading.Lock()
+
+    # Timers live in a heap, cancelled ones are discarded lazily.
+    self.timers = []
+    self.timers_cancelled = 0
+    self.timer_lock = threading.Lock()
+    self.timer_seq = itertools.count()
+    self.signalled = collections.deque()
+
+    # One-shot readiness callbacks, used while connecting.
+    self.waiting = {}
+    self.resolver = Resolver()
+
+    # The self-pipe lets other threads interrupt a blocking poll.
+    self.wakeup_r, self.wakeup_w = os.pipe()
+    for pfd in (self.wakeup_r, self.wakeup_w):
+      fcntl.fcntl(pfd, fcntl.F_SETFL,
+                  fcntl.fcntl(pfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.poller.register(self.wakeup_r)
+
+  def wakeup(self):
+    try:
+      os.write(self.wakeup_w, 'x')
+    except (IOError, OSError), err:
+      # A full pipe means a wakeup is already pending.
+      if err.errno not in self.HARMLESS_ERRNOS:
+        raise
+
+  def drain_wakeups(self):
+    try:
+      while os.read(self.wakeup_r, 4096):
+        pass
+    except (IOError, OSError), err:
+      if err.errno not in self.HARMLESS_ERRNOS:
+        raise
 
   def stop(self):
     self.keep_running = False
-    for sleeper in self.sleepers:
+    for sleeper in self.sleepers.keys():
       self.awaken_sleeper(sleeper)
+    self.wakeup()
 
-  def add(self, fd, owner):
+  def add(self, fd, owner, callback_eof=None):
+    fileno = fd.fileno()
     self.fds_by_uid[owner.uid] = fd
     self.conns_by_fd[fd] = owner
+    if callback_eof:
+      self.eof_callbacks[fd] = callback_eof
+    self.fds_by_fileno[fileno] = fd
+    self.filenos_by_fd[fd] = fileno
+    self.poller.register(fileno)
+    self.interest[fd] = (True, False)
+    if fd in self.outbufs:
+      self.write_lock.acquire()
+      self.pending_writes.add(fd)
+      self.write_lock.release()
+    self.wakeup()
+
+  def unregister(self, fd):
+    fileno = self.filenos_by_fd.pop(fd, None)
+    if fileno is not None:
+      self.poller.unregister(fileno)
+      del self.fds_by_fileno[fileno]
+    self.write_lock.acquire()
+    for state in (self.outbufs, self.outbytes, self.interest):
+      state.pop(fd, None)
+    self.paused.discard(fd)
+    self.want_read.discard(fd)
+    self.closing.discard(fd)
+    self.pending_writes.discard(fd)
+    self.write_lock.release()
 
   def remove_owner(self, owner):
-    del self.conns_by_fd[self.fds_by_uid[owner.uid]]
+    fd = self.fds_by_uid[owner.uid]
+    self.unregister(fd)
+    self.eof_callbacks.pop(fd, None)
+    del self.conns_by_fd[fd]
     del self.fds_by_uid[owner.uid]
 
   def remove_fd(self, fd):
+    """Forget a connection which has gone away, telling whoever cares."""
+    self.unregister(fd)
     del self.fds_by_uid[self.conns_by_fd[fd].uid]
     del self.conns_by_fd[fd]
+    callback_eof = self.eof_callbacks.pop(fd, None)
+    if callback_eof:
+      try:
+        callback_eof()
+      except:
+        print '%s' % traceback.format_exc()
+
+  def wait_for(self, fd, callback, readable=False, writable=True):
+    """Call callback() once, when fd becomes readable or writable."""
+    fileno = fd.fileno()
+    if fileno not in self.waiting:
+      self.poller.register(fileno)
+    self.waiting[fileno] = callback
+    self.poller.modify(fileno, readable, writable)
+    self.wakeup()
+
+  def unwait(self, fd):
+    fileno = fd.fileno()
+    if self.waiting.pop(fileno, None):
+      self.poller.unregister(fileno)
+
+  def call_soon(self, callback, *args):
+    """Run callback(*args) on the loop thread as soon as possible."""
+    return self.schedule(Timer(0, None, callback, args))
+
+  def call_at(self, when, callback, *args):
+    """Run callback(*args) on the loop thread at time `when`."""
+    return self.schedule(Timer(when, None, callback, args))
+
+  def call_later(self, delay, callback, *args):
+    """Run callback(*args) on the loop thread in `delay` seconds."""
+    return self.schedule(Timer(time.time() + delay, None, callback, args))
+
+  def call_from_signal(self, callback, *args):
+    """Like call_soon, but safe in a signal handler as it takes no locks."""
+    self.signalled.append((callback, args))
+    self.wakeup()
+
+  def call_every(self, interval, callback, *args):
+    """Run callback(*args) on the loop thread every `interval` seconds."""
+    return self.schedule(Timer(time.time() + interval, interval,
+                               callback, args))
+
+  def schedule(self, timer):
+    self.timer_lock.acquire()
+    try:
+      timer.pending = True
+      heapq.heappush(self.timers, (timer.when, self.timer_seq.next(), timer))
+      earliest = (self.timers[0][2] is timer)
+    finally:
+      self.timer_lock.release()
+    if earliest:
+      self.wakeup()
+    return timer
+
+  def cancel(self, timer):
+    """Cancel a timer returned by call_at, call_later or call_every."""
+    if timer is None or timer.cancelled:
+      return
+    self.timer_lock.acquire()
+    try:
+      timer.cancelled = True
+      if timer.pending:
+        self.timers_cancelled += 1
+        # Compact the heap if it is mostly dead weight.
+        if self.timers_cancelled > max(64, len(self.timers) // 2):
+          self.timers = [t for t in self.timers if not t[2].cancelled]
+          heapq.heapify(self.timers)
+          self.timers_cancelled = 0
+    finally:
+      self.timer_lock.release()
+
+  def run_timers(self):
+    now = time.time()
+    due = []
+    self.timer_lock.acquire()
+    try:
+      while self.timers and self.timers[0][0] <= now:
+        timer = heapq.heappop(self.timers)[2]
+        timer.pending = False
+        if timer.cancelled:
+          self.timers_cancelled -= 1
+        else:
+          due.append(timer)
+    finally:
+      self.timer_lock.release()
+
+    for timer in due:
+      try:
+        timer.callback(*timer.args)
+      except:
+        print '%s' % traceback.format_exc()
+      if timer.interval and not timer.cancelled:
+        timer.when = max(now, timer.when + timer.interval)
+        self.schedule(timer)
 
   def add_sleeper(self, waketime, condition, info):
     if not self.keep_running:
       raise SelectAborted()
     ev = (waketime, condition, info)
-    self.sleepers.append(ev)
-    self.sleepers.sort()
+    self.sleepers[ev] = self.call_at(waketime, self.awaken_sleeper, ev)
     return ev
 
   def remove_sleeper(self, ev):
-    try:
-      self.sleepers.remove(ev)
-    except ValueError:
-      pass
+    self.cancel(self.sleepers.pop(ev, None))
 
   def awaken_sleeper(self, ev):
+    self.sleepers.pop(ev, None)
     wt, cond, info = ev
     cond.acquire()
     cond.notify()
@@ -91,28 +440,138 @@ class SelectLoop(threading.Thread):
     cond.release()
 
   def sendall(self, fd, data):
+    """Queue data for fd, returns False if the queue is over-full."""
+    if self.DEBUG:
+      print '>>> %s' % data.encode('string_escape')
+    self.write_lock.acquire()
     try:
-      if self.DEBUG:
-        print '>>> %s' % data.encode('string_escape')
-      return fd.sendall(data)
-    except SSL.WantWriteError:
-      return self.sendall(fd, data)
-    except IOError, err:
-      if err.errno == errno.EINTR:
-        return self.sendall(fd, data)
+      if fd not in self.outbufs:
+        self.outbufs[fd] = collections.deque()
+        self.outbytes[fd] = 0
+      self.outbufs[fd].append(data)
+      self.outbytes[fd] += len(data)
+      queued = self.outbytes[fd]
+      self.pending_writes.add(fd)
+    finally:
+      self.write_lock.release()
+    if threading.current_thread() is self:
+      self.flush(fd)
+    else:
+      self.wakeup()
+    return (queued < self.HIGH_WATERMARK)
+
+  def close(self, fd):
+    """Remove and close fd once all queued data has been written."""
+    self.write_lock.acquire()
+    self.closing.add(fd)
+    self.pending_writes.add(fd)
+    self.write_lock.release()
+    if threading.current_thread() is self:
+      self.flush(fd)
+    else:
+      self.wakeup()
+
+  def flush(self, fd):
+    """Write as much queued data as the socket will take without blocking."""
+    dead = False
+    self.write_lock.acquire()
+    try:
+      self.pending_writes.discard(fd)
+      self.want_read.discard(fd)
+      outbuf = self.outbufs.get(fd)
+      while outbuf and fd in self.filenos_by_fd:
+        try:
+          sent = fd.send(outbuf[0])
+        except SSL.WantWriteError:
+          break
+        except SSL.WantReadError, err:
+          # TLS must hear from the peer first: retry once fd is readable,
+          # waiting for writable would just spin the loop.
+          # Without pyOpenSSL, WantReadError is ssl.SSLError: check which.
+          if (sockschain.HAVE_PYOPENSSL or
+              err.args[0] == ssl.SSL_ERROR_WANT_READ):
+            self.want_read.add(fd)
+          elif err.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+            dead = True
+          break
+        except (IOError, socket.error), err:
+          dead = not (err.args and err.args[0] in self.HARMLESS_ERRNOS)
+          break
+        except (SSL.Error, SSL.ZeroReturnError, SSL.SysCallError):
+          dead = True
+          break
+        self.outbytes[fd] -= sent
+        if sent < len(outbuf[0]):
+          outbuf[0] = outbuf[0][sent:]
+          break
+        outbuf.popleft()
+      if fd in self.filenos_by_fd and not dead:
+        self.update_interest(fd)
+      closed = (fd in self.closing and not self.outbufs.get(fd))
+    finally:
+      self.write_lock.release()
+    if (dead or closed) and fd in self.conns_by_fd:
+      self.remove_fd(fd)
+    if closed:
+      fd.close()
+
+  def update_interest(self, fd):
+    queued = self.outbytes.get(fd, 0)
+    if queued >= self.HIGH_WATERMARK:
+      self.paused.add(fd)
+    elif queued <= self.LOW_WATERMARK:
+      self.paused.discard(fd)
+    if not queued:
+      self.outbufs.pop(fd, None)
+      self.outbytes.pop(fd, None)
+    want_read = fd in self.want_read
+    interest = (want_read or fd not in self.paused,
+                queued > 0 and not want_read)
+    if self.interest.get(fd) != interest:
+      self.interest[fd] = interest
+      self.poller.modify(self.filenos_by_fd[fd], *interest)
+
+  def poll_timeout(self):
+    """Sleep until the next timer is due, or until woken up."""
+    try:
+      return max(0, self.timers[0][0] - time.time())
+    except IndexError:
+      return None
 
   def run(self):
-    d = 0.1
     while self.keep_running:
-      ready = select.select(self.conns_by_fd.keys(), [], [], d)[0]
-      for fd in ready:
+      try:
+        ready = self.poller.poll(self.poll_timeout())
+      except (IOError, OSError, select.error), err:
+        if err.args[0] not in self.HARMLESS_ERRNOS:
+          raise
+        ready = []
+      for fileno, readable, writable in ready:
+        if fileno == self.wakeup_r:
+          self.drain_wakeups()
+          continue
+        if fileno in self.waiting:
+          callback = self.waiting.pop(fileno)
+          self.poller.unregister(fileno)
+          try:
+            callback()
+          except:
+            print '%s' % traceback.format_exc()
+          continue
+        fd = self.fds_by_fileno.get(fileno)
+        if fd is None:
+          continue
+        if writable or (readable and fd in self.want_read):
+          self.flush(fd)
+        if not readable or fd not in self.conns_by_fd:
+          continue
         try:
           data = fd.recv(32*1024)
           if self.DEBUG:
             print '<<< %s' % data.encode('string_escape')
           self.conns_by_fd[fd].process_data(data,
                                             lambda d: self.sendall(fd, d))
-          if data == '':
+          if data == '' and fd in self.conns_by_fd:
             self.remove_fd(fd)
         except SSL.WantReadError:
           pass
@@ -125,44 +584,166 @@ class SelectLoop(threading.Thread):
         except (SSL.Error, SSL.ZeroReturnError, SSL.SysCallError):
           self.remove_fd(fd)
 
-      if ready:
-        d = 0.1
-      else:
-        d = min(1, d+0.1)
+      if self.pending_writes:
+        self.write_lock.acquire()
+        pending, self.pending_writes = self.pending_writes, set()
+        self.write_lock.release()
+        for fd in pending:
+          self.flush(fd)
 
-      if self.sleepers:
-        now = time.time()
+      while self.signalled:
+        callback, args = self.signalled.popleft()
         try:
-          while self.sleepers and self.sleepers[0][0] <= now:
-            self.awaken_sleeper(self.sleepers.pop(0))
-        except IndexError:
-          pass
+          callback(*args)
+        except:
+          print '%s' % traceback.format_exc()
 
+      self.run_timers()
 
-class Connect(threading.Thread):
-  """This class implements a non-blocking connect in a thread of its own."""
 
-  def __init__(self, proto, hostname, port, callback_ok, callback_err=None):
-    threading.Thread.__init__(self)
+class Resolver:
+  """A small, bounded pool of threads for blocking DNS lookups."""
+
+  def __init__(self, threads=2):
+    self.queue = Queue.Queue()
+    self.threads = threads
+    self.workers = []
+    self.lock = threading.Lock()
+
+  def resolve(self, hostname, port, callback):
+    """Look up hostname, calling callback(addrinfo or None) when done."""
+    self.lock.acquire()
+    try:
+      while len(self.workers) < self.threads:
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+    finally:
+      self.lock.release()
+    self.queue.put((hostname, port, callback))
+
+  def work(self):
+    while True:
+      hostname, port, callback = self.queue.get()
+      try:
+        addrs = socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM)
+      except (socket.error, socket.gaierror, UnicodeError):
+        addrs = None
+      try:
+        callback(addrs)
+      except:
+        print '%s' % traceback.format_exc()
+
+
+class Connect:
+  """This class implements a non-blocking connect driven by the loop."""
+
+  TIMEOUT = 30
+
+  def __init__(self, event_loop, proto, hostname, port,
+                     callback_ok, callback_err=None):
+    self.event_loop = event_loop
     self.hostname = hostname
     self.proto = proto
     self.port = int(port)
     self.callback_ok = callback_ok
     self.callback_err = callback_err
+    self.addrs = []
+    self.sock = None
+    self.timer = None
 
-  def run(self):
-    sock = sockschain.socksocket()
-    if self.proto in ('ircs', 'ssl'):
-      if sockschain.HAVE_SSL:
-        chain = ['default']
-        chain.append('ssl!%s!%s' % (self.hostname, self.port))
-        for hop in chain:
-          sock.addproxy(*sockschain.parseproxy(hop))
+  def start(self):
+    self.event_loop.resolver.resolve(self.hostname, self.port,
+      lambda addrs: self.event_loop.call_soon(self.resolved, addrs))
+
+  def resolved(self, addrs):
+    self.addrs = addrs or []
+    self.try_next()
+
+  def try_next(self):
+    """Start connecting to the next address, non-blocking."""
+    self.close()
+    while self.addrs:
+      family, socktype, proto, cname, sockaddr = self.addrs.pop(0)
+      try:
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(sockaddr)
+      except socket.error, e:
+        err = e.args[0]
+      if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        self.timer = self.event_loop.call_later(self.TIMEOUT, self.try_next)
+        return self.event_loop.wait_for(self.sock, self.tcp_connected)
+      self.close()
+    # All addresses failed, there is no socket left to report.
+    if self.callback_err:
+      self.callback_err()
+
+  def close(self):
+    self.event_loop.cancel(self.timer)
+    if self.sock is not None:
+      self.event_loop.unwait(self.sock)
+      self.sock.close()
+      self.sock = None
+
+  def tcp_connected(self):
+    if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+      return self.try_next()
+    if self.proto in ('ircs', 'ssl') and sockschain.HAVE_SSL:
+      try:
+        self.sock = self.tls_wrap(self.sock)
+      except (socket.error, SSL.Error):
+        return self.try_next()
+      return self.tls_handshake()
+    return self.done()
+
+  def tls_wrap(self, sock):
+    """Wrap sock for TLS, verifying the server name like sockschain does."""
+    if sockschain.HAVE_PYOPENSSL:
+      def verify(conn, x509, errnum, depth, rc):
+        if errnum != 0:
+          return False
+        if depth != 0:
+          return True
+        return (sockschain.SSL_CheckName(
+                  x509.get_subject().commonName.lower(),
+                  x509.digest('sha1').replace(':', ''),
+                  [self.hostname]) > 0)
+      ctx = SSL.Context(SSL.SSLv23_METHOD)
+      ctx.load_verify_locations(sockschain.TLS_CA_CERTS)
+      ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
+                     verify)
+      conn = SSL.Connection(ctx, sock)
+      conn.set_connect_state()
+      return conn
+    else:
+      return ssl.wrap_socket(sock, cert_reqs=ssl.CERT_REQUIRED,
+                                   ca_certs=sockschain.TLS_CA_CERTS,
+                                   do_handshake_on_connect=False)
+
+  def tls_handshake(self):
+    """Advance the TLS handshake as far as we can without blocking."""
     try:
-      sock.connect((self.hostname, self.port))
-      sock.setblocking(0)
-      self.callback_ok(sock)
-    except:
-      if self.callback_err:
-        self.callback_err(sock)
+      self.sock.do_handshake()
+    except SSL.WantWriteError:
+      return self.event_loop.wait_for(self.sock, self.tls_handshake)
+    except SSL.WantReadError, err:
+      # Without pyOpenSSL, WantReadError is ssl.SSLError: check which.
+      if sockschain.HAVE_PYOPENSSL or err.args[0] == ssl.SSL_ERROR_WANT_READ:
+        return self.event_loop.wait_for(self.sock, self.tls_handshake,
+                                        readable=True, writable=False)
+      elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+        return self.event_loop.wait_for(self.sock, self.tls_handshake)
+      return self.try_next()
+    except (socket.error, SSL.Error, SSL.ZeroReturnError, SSL.SysCallError):
+      return self.try_next()
+    if not (sockschain.HAVE_PYOPENSSL or
+            sockschain.SSL_CheckPeerName(self.sock, [self.hostname])):
+      return self.try_next()
+    return self.done()
 
+  def done(self):
+    self.event_loop.cancel(self.timer)
+    sock, self.sock = self.sock, None
+    self.callback_ok(sock)
@@ -23,7 +23,9 @@
 #
 # Python standard
 import hashlib
+import json
 import random
+from collections import OrderedDict, deque
 import socket
 import threading
 import time
@@ -53,6 +55,331 @@ def md5hex(data):
   return h1.hexdigest().lower()
 
 
+def json_entry(entry):
+  """Compact JSON for a log entry; IRC text which is not UTF-8 is Latin-1."""
+  try:
+    return json.dumps(entry, separators=(',', ':'))
+  except UnicodeDecodeError:
+    return json.dumps(entry, separators=(',', ':'), encoding='latin-1')
+
+
+class ChannelLog:
+  """A fixed-capacity ring buffer of [seq, info, ts] entries, oldest first.
+
+  Every entry gets the next number in a per-channel sequence, so entries
+  in the buffer are numbered consecutively and can be found by index.
+  Entries are serialized to JSON once, when they are logged.
+
+  Only the event loop changes the log, but the json_* methods are also
+  used by HTTP threads, so changes and those reads hold the lock."""
+
+  def __init__(self, maxlines, next_seq=1):
+    self.slots = [None] * max(1, int(maxlines))
+    self.encoded = [None] * len(self.slots)
+    self.head = 0
+    self.count = 0
+    self.next_seq = next_seq
+    self.json_cache = {}
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    slots, head, count = self.slots, self.head, self.count
+    for i in xrange(0, count):
+      yield slots[(head + i) % len(slots)]
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return [self[i] for i in xrange(*idx.indices(self.count))]
+    if idx < 0:
+      idx += self.count
+    if idx < 0 or idx >= self.count:
+      raise IndexError('ChannelLog index out of range')
+    return self.slots[(self.head + idx) % len(self.slots)]
+
+  def append(self, info, ts=None):
+    """Log info, overwriting the oldest entry if full. Returns the seq."""
+    seq = self.next_seq
+    entry = [seq, info, int(ts or time.time())]
+    encoded = json_entry(entry)
+    self.lock.acquire()
+    try:
+      if self.count < len(self.slots):
+        pos = (self.head + self.count) % len(self.slots)
+        self.count += 1
+      else:
+        pos = self.head
+        self.head = (self.head + 1) % len(self.slots)
+      self.slots[pos] = entry
+      self.encoded[pos] = encoded
+      self.next_seq += 1
+      self.json_cache = {}
+    finally:
+      self.lock.release()
+    return seq
+
+  def restore(self, lines, last_seq):
+    """Seed an empty log from JSON lines, continuing after last_seq.
+
+    Only the newest lines which are numbered consecutively up to last_seq
+    are loaded, so the numbering of the buffer stays consecutive."""
+    if self.next_seq != 1:
+      raise ValueError('Can only restore into an empty ChannelLog')
+    entries = []
+    expect = last_seq
+    for line in reversed(lines[-len(self.slots):]):
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        break
+      if entry[0] != expect:
+        break
+      entries[:0] = [(entry, line)]
+      expect -= 1
+    self.lock.acquire()
+    try:
+      for pos, (entry, line) in enumerate(entries):
+        self.slots[pos] = entry
+        self.encoded[pos] = line
+      self.head = 0
+      self.count = len(entries)
+      self.next_seq = last_seq + 1
+      self.json_cache = {}
+    finally:
+      self.lock.release()
+    return self
+
+  def index_after(self, cursor):
+    """Return the index of the first entry logged after cursor."""
+    if not cursor:
+      return 0
+    if isinstance(cursor, basestring):
+      if '-' in cursor:
+        return self.index_after_time(cursor)
+      try:
+        cursor = int(cursor)
+      except ValueError:
+        cursor = 0
+    if not self.count or cursor >= self.next_seq:
+      # Cursors from the future were handed out before a restart.
+      return 0
+    return max(0, cursor - self.slots[self.head][0] + 1)
+
+  def index_after_time(self, log_id):
+    """Map a legacy 'TIME-COUNTER' log ID to entries from that second on."""
+    try:
+      ts = int(log_id.split('-', 1)[0])
+    except ValueError:
+      ts = 0
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self[mid][2] >= ts:
+        hi = mid
+      else:
+        lo = mid + 1
+    return lo
+
+  def after(self, cursor):
+    """Return all entries logged after cursor, a sequence number."""
+    return self[self.index_after(cursor):]
+
+  def json_entries_after(self, cursor):
+    """Return (seq, JSON) pairs for all entries logged after cursor."""
+    self.lock.acquire()
+    try:
+      head, count = self.head, self.count
+      slots, encoded, size = self.slots, self.encoded, len(self.slots)
+      return [(slots[(head + i) % size][0], encoded[(head + i) % size])
+              for i in xrange(self.index_after(cursor), count)]
+    finally:
+      self.lock.release()
+
+  def json_after(self, cursor, limit=0, match=None):
+    """Return entries after cursor as a JSON list, ready to send.
+
+    Unfiltered bodies are cached until the next append, so everyone
+    waiting at the same cursor shares one body."""
+    self.lock.acquire()
+    try:
+      head, count = self.head, self.count
+      start = self.index_after(cursor)
+      if match is None:
+        key = (self.next_seq - count + start, limit)
+        body = self.json_cache.get(key)
+        if body is not None:
+          return body
+      indexes = range(start, count)
+      if match is not None:
+        indexes = [i for i in indexes if match(self[i][1])]
+      if limit:
+        indexes = indexes[-limit:]
+      encoded, size = self.encoded, len(self.encoded)
+      body = '[%s]' % ','.join(encoded[(head + i) % size] for i in indexes)
+      if match is None:
+        self.json_cache[key] = body
+      return body
+    finally:
+      self.lock.release()
+
+  def resize(self, maxlines):
+    """Change the capacity, keeping the newest entries that still fit."""
+    maxlines = max(1, int(maxlines))
+    head, size = self.head, len(self.slots)
+    kept = [(head + i) % size
+            for i in xrange(max(0, self.count - maxlines), self.count)]
+    padding = [None] * (maxlines - len(kept))
+    self.lock.acquire()
+    try:
+      self.slots = [self.slots[pos] for pos in kept] + padding
+      self.encoded = [self.encoded[pos] for pos in kept] + padding
+      self.head = 0
+      self.count = len(kept)
+      self.json_cache = {}
+    finally:
+      self.lock.release()
+    return self
+
+
+class ChannelMode:
+  """A parsed snapshot of a channel's mode. Treat it as read-only."""
+
+  FLAG_MODES = {
+    'a': 'anonymous',
+    'i': 'invite_only',
+    'm': 'moderated',
+    'n': 'must_join',
+    'q': 'quiet',
+    's': 'secret',
+    't': 'topic_locked'
+  }
+  LIST_MODES = {
+    'b': 'bans',
+    'I': 'invite_mask'
+  }
+  PARAM_MODES = {
+    'k': 'key',
+    'l': 'limit'
+  }
+  # These change a member's status, not the channel's.
+  USER_MODES = 'ohv'
+
+  def __init__(self, modes=None, log_id=0):
+    if modes is None:
+      modes = {'n': True, 's': True}
+    self.modes = modes
+    self.log_id = log_id
+
+    flags = ''.join(sorted(m for m in modes if m in self.FLAG_MODES))
+    params = [m for m in sorted(self.PARAM_MODES) if m in modes]
+    self.raw = ' '.join(['+' + flags + ''.join(params)] +
+                        [modes[m] for m in params])
+
+    self.info = info = {
+      'event': 'mode',
+      'log_id': log_id,
+      'raw_mode': self.raw
+    }
+    for m, value in modes.iteritems():
+      name = (self.FLAG_MODES.get(m) or self.LIST_MODES.get(m) or
+              self.PARAM_MODES.get(m))
+      info[name] = value
+    self.requires_join = bool(info.get('secret') or
+                              info.get('key') or
+                              info.get('invite_only'))
+
+    # What we tell people who have not joined: no keys or other details.
+    self.hidden = dict((k, v and True) for k, v in info.iteritems())
+    self.hidden['event'] = 'pleasejoin'
+
+  def changed(self, mode, params, log_id, strict=True):
+    """Return a new snapshot with a mode change applied.
+
+    Returns None if strict and the change contains modes we do not
+    understand, since we cannot know which parameters they consume."""
+    modes = dict((m, isinstance(v, list) and v[:] or v)
+                 for m, v in self.modes.iteritems())
+    params = list(params)
+    adding = True
+    try:
+      for m in mode:
+        if m in '+-':
+          adding = (m == '+')
+        elif m in self.FLAG_MODES:
+          if adding:
+            modes[m] = True
+          else:
+            modes.pop(m, None)
+        elif m in self.LIST_MODES:
+          mask = params.pop(0)
+          masks = modes.setdefault(m, [])
+          if adding and mask not in masks:
+            masks.append(mask)
+          elif not adding and mask in masks:
+            masks.remove(mask)
+          if not masks:
+            del modes[m]
+        elif m in self.PARAM_MODES:
+          if adding:
+            modes[m] = params.pop(0)
+          else:
+            modes.pop(m, None)
+            if m == 'k' and params:
+              params.pop(0)
+        elif m in self.USER_MODES:
+          params.pop(0)
+        elif strict:
+          return None
+    except IndexError:
+      if strict:
+        return None
+    return ChannelMode(modes, log_id)
+
+
+class IrcUserIndex(dict):
+  """A dict of IrcClients by uid, which are also indexed by nick and log ID."""
+
+  def __init__(self):
+    dict.__init__(self)
+    self.by_nick = {}
+    self.by_log_id = {}
+    self.lock = threading.Lock()
+
+  def __setitem__(self, uid, user):
+    if uid in self:
+      del self[uid]
+    dict.__setitem__(self, uid, user)
+    user.index = self
+    self.add_user(user)
+
+  def __delitem__(self, uid):
+    user = self[uid]
+    dict.__delitem__(self, uid)
+    self.remove_user(user)
+    user.index = None
+
+  def add_user(self, user):
+    self.lock.acquire()
+    try:
+      self.by_nick[user.low_nick] = user
+      if user.log_id:
+        self.by_log_id[user.log_id] = user
+    finally:
+      self.lock.release()
+
+  def remove_user(self, user):
+    self.lock.acquire()
+    try:
+      if self.by_nick.get(user.low_nick) is user:
+        del self.by_nick[user.low_nick]
+      if self.by_log_id.get(user.log_id) is user:
+        del self.by_log_id[user.log_id]
+    finally:
+      self.lock.release()
+
+
 class IrcClient:
   """This is a bare-bones IRC client which logs on and ping/pongs."""
 
@@ -65,6 +392,13 @@ class IrcClient:
   low_nick = '<unset>'
   profile = None
   log_id = None
+  index = None
+
+  # Connection supervision state, managed by Mutiny
+  server_index = 0
+  connect_failures = 0
+  reconnect_timer = None
+  connected_at = 0
 
   def __init__(self):
     self.partial = ''
@@ -72,8 +406,22 @@ class IrcClient:
     self.seen = time.time()
 
   def irc_nickname(self, nickname):
+    index = self.index
+    if index is not None:
+      index.remove_user(self)
     self.nickname = str(nickname)
     self.low_nick = str(nickname).lower()
+    if index is not None:
+      index.add_user(self)
+    return self
+
+  def irc_log_id(self, log_id):
+    index = self.index
+    if index is not None:
+      index.remove_user(self)
+    self.log_id = log_id
+    if index is not None:
+      index.add_user(self)
     return self
 
   def irc_fullname(self, fullname):
@@ -110,6 +458,10 @@ class IrcClient:
     write_cb(('NICK %s\r\nUSER %s x x :%s\r\n'
               ) % (self.nickname, self.username, fullname or self.fullname))
 
+  def process_disconnect(self):
+    """Forget per-connection state, we will be starting over."""
+    self.partial = ''
+
   def process_data(self, data, write_cb):
     """Process data, presumably from a server."""
     lines = (self.partial+data).splitlines(True)
@@ -160,8 +512,7 @@ class IrcClient:
   ### Protocol callbacks follow ###
 
   def on_001(self, parts, write_cb):
-    self.nickname = parts[2]
-    self.low_nick = parts[2].lower()
+    self.irc_nickname(parts[2])
 
   def on_002(self, parts, write_cb): """Server info."""
   def on_003(self, parts, write_cb): """Server uptime."""
@@ -189,6 +540,11 @@ class IrcClient:
       write_cb('JOIN %s\r\n' % '\r\nJOIN '.join(self.channels))
 
   def on_396(self, parts, write_cb): """Hidden host."""
+  def on_401(self, parts, write_cb): """No such nick/channel."""
+
+  def on_422(self, parts, write_cb):
+    """No MOTD, treat as end of MOTD."""
+    return self.on_376(parts, write_cb)
 
   def on_433(self, parts, write_cb):
     """Nickname already in use, generate another one."""
@@ -213,6 +569,12 @@ class IrcClient:
     write_cb('QUIT\r\n')
 
   def on_join(self, parts, write_cb): """User JOINed."""
+
+  def on_nick(self, parts, write_cb):
+    """Track our own nickname, if the server changes it."""
+    if parts[0].split('!', 1)[0].lower() == self.low_nick:
+      self.irc_nickname(parts[2])
+
   def on_notice(self, parts, write_cb): """Bots must ignore NOTICE messages."""
   def on_part(self, parts, write_cb): """User dePARTed."""
 
@@ -242,28 +604,65 @@ class IrcLogger(IrcClient):
   """This client logs what he sees."""
 
   MAXLINES = 200
+  # How many departed users we remember, so returning users keep their uid.
+  MAXDEPARTED = 1000
+
+  # WHOIS pipelining: requests in flight, and a token bucket which keeps
+  # us within the server's flood limits. Requests which get no reply
+  # within WHOIS_TIMEOUT seconds are given up on.
+  WHOIS_OUTSTANDING = 4
+  WHOIS_TIMEOUT = 30
+  WHOIS_BURST = 5
+  WHOIS_RATE = 1.0
+  WHOX_TOKEN = '152'
+
+  event_loop = None
 
   def __init__(self):
     IrcClient.__init__(self)
     self.logs = {}
-    self.want_whois = []
+    self.maxlines = {}
+    self.want_whois = deque()
+    self.want_whois_set = set()
+    self.whois_pending = {}
+    self.whois_tokens = self.WHOIS_BURST
+    self.whois_token_ts = time.time()
+    self.whois_timer = None
+    self.whois_timer_ts = 0
+    self.who_names = {}
+    self.isupport_whox = False
     self.whois_data = {}
-    self.whois_cache = {}
+    self.whois_by_nick = {}
+    self.whois_departed = OrderedDict()
     self.channel_mode = {}
     self.watchers = {}
-    self.users = {}
+    self.subscribers = {}
+    self.users = IrcUserIndex()
+
+  def process_disconnect(self):
+    IrcClient.process_disconnect(self)
+    if self.whois_timer is not None:
+      self.event_loop.cancel(self.whois_timer)
+      self.whois_timer = None
+    self.want_whois = deque()
+    self.want_whois_set = set()
+    self.whois_pending = {}
+    self.who_names = {}
+    self.isupport_whox = False
+    self.whois_data = {}
+
+  def irc_event_loop(self, event_loop):
+    """Timers on the event loop pace our WHOIS requests."""
+    self.event_loop = event_loop
+    return self
 
   def irc_find_user(self, nickname=None, log_id=None):
-    try:
-      nickname = nickname.lower()
-      user = None
-      for uid, user in self.users.iteritems():
-        if ((nickname and (user.low_nick == nickname)) or
-            (log_id and (user.log_id == log_id))):
-          return user
-    except (ValueError, KeyError):
-      pass
-    return None
+    user = None
+    if nickname:
+      user = self.users.by_nick.get(nickname.lower())
+    if log_id and not user:
+      user = self.users.by_log_id.get(log_id)
+    return user
 
   def irc_augment_whois(self, nickname, user):
     if user:
@@ -278,46 +677,126 @@ class IrcLogger(IrcClient):
         'avatar': '/_skin/avatar_%s.jpg' % md5hex(nickname)[0]
       }
 
+  def irc_maxlines(self, channel, maxlines):
+    self.maxlines[channel] = int(maxlines)
+    if channel in self.logs:
+      self.logs[channel].resize(maxlines)
+    return self
+
   def irc_channel_log(self, channel):
     if channel not in self.channels:
-      return []
+      return ChannelLog(1)
     if channel not in self.logs:
-      self.logs[channel] = []
-    else:
-      while len(self.logs[channel]) > self.MAXLINES:
-        self.logs[channel].pop(0)
+      self.logs[channel] = ChannelLog(self.maxlines.get(channel,
+                                                        self.MAXLINES))
     return self.logs[channel]
 
+  def irc_restore_log(self, channel, lines, last_seq):
+    """Seed a channel's log with entries from a previous run."""
+    self.irc_channel_log(channel).restore(lines, last_seq)
+    return self
+
   def irc_watch_channel(self, channel, watcher):
+    """Resolve the watcher (a Future) when something is logged."""
     if channel not in self.watchers:
-      self.watchers[channel] = [watcher]
+      self.watchers[channel] = set([watcher])
     else:
-      self.watchers[channel].append(watcher)
+      self.watchers[channel].add(watcher)
+
+  def irc_unwatch_channel(self, channel, watcher):
+    self.watchers.get(channel, set()).discard(watcher)
 
   def irc_notify_watchers(self, channel):
-    watchers, self.watchers[channel] = self.watchers.get(channel, []), []
-    now = time.time()
-    for expire, cond, info in watchers:
-      if now <= expire:
-        cond.acquire()
-        cond.notify()
-        cond.release()
-
-  def irc_channel_log_append(self, channel, data):
-    self.irc_channel_log(channel).append(data)
+    watchers, self.watchers[channel] = self.watchers.get(channel, set()), set()
+    for watcher in watchers:
+      watcher.set_result(channel)
+
+  def irc_subscribe(self, channel, callback):
+    """Call callback(channel, seq) whenever something is logged."""
+    self.subscribers.setdefault(channel, set()).add(callback)
+
+  def irc_unsubscribe(self, channel, callback):
+    self.subscribers.get(channel, set()).discard(callback)
+
+  def irc_channel_log_append(self, channel, info):
+    seq = self.irc_channel_log(channel).append(info)
     self.irc_notify_watchers(channel)
+    for callback in list(self.subscribers.get(channel, [])):
+      try:
+        callback(channel, seq)
+      except:
+        print '%s' % traceback.format_exc()
+    return seq
 
   def irc_whois(self, nick, write_cb):
+    self.whois_pending[nick.lower()] = time.time()
     write_cb('WHOIS %s\r\n' % nick)
-    try:
-      while True:
-        self.want_whois.remove(nick)
-    except ValueError:
-      pass
+
+  def irc_want_whois(self, nick, urgent=False):
+    """Queue a WHOIS, urgent ones (people talking) go first."""
+    low_nick = nick.lower()
+    if low_nick in self.whois_pending or low_nick == self.low_nick:
+      return
+    if urgent:
+      # Stale duplicates further back are skipped by irc_whois_pump.
+      self.want_whois.appendleft(nick)
+    elif low_nick not in self.want_whois_set:
+      self.want_whois.append(nick)
+    self.want_whois_set.add(low_nick)
+
+  def irc_whois_token(self):
+    now = time.time()
+    self.whois_tokens = min(self.WHOIS_BURST, self.whois_tokens +
+                            (now - self.whois_token_ts) * self.WHOIS_RATE)
+    self.whois_token_ts = now
+    if self.whois_tokens >= 1:
+      self.whois_tokens -= 1
+      return True
+    return False
+
+  def irc_whois_pump(self, write_cb, from_timer=False):
+    """Send as many queued WHOIS requests as we may right now."""
+    if from_timer:
+      self.whois_timer = None
+    now = time.time()
+    for low_nick, ts in self.whois_pending.items():
+      if now - ts >= self.WHOIS_TIMEOUT:
+        del self.whois_pending[low_nick]
+    while (self.want_whois and
+           len(self.whois_pending) < self.WHOIS_OUTSTANDING):
+      nick = self.want_whois[0]
+      if nick.lower() not in self.want_whois_set:
+        self.want_whois.popleft()
+      elif self.irc_whois_token():
+        self.want_whois.popleft()
+        self.want_whois_set.remove(nick.lower())
+        self.irc_whois(nick, write_cb)
+      else:
+        self.irc_whois_later((1 - self.whois_tokens) / self.WHOIS_RATE,
+                             write_cb)
+        break
+    else:
+      if self.want_whois:
+        # All slots taken, check again when the oldest request expires.
+        self.irc_whois_later(min(self.whois_pending.values()) +
+                             self.WHOIS_TIMEOUT - now, write_cb)
+
+  def irc_whois_later(self, delay, write_cb):
+    """Make sure irc_whois_pump runs again within delay seconds."""
+    if self.event_loop is None:
+      return
+    when = time.time() + delay
+    if self.whois_timer is not None:
+      if self.whois_timer_ts <= when:
+        return
+      self.event_loop.cancel(self.whois_timer)
+    self.whois_timer_ts = when
+    self.whois_timer = self.event_loop.call_later(delay, self.irc_whois_pump,
+                                                  write_cb, True)
 
   def irc_channel_users(self, channel):
     users = {}
-    for ts, info in irc.channel_log(channel):
+    for seq, info, ts in self.irc_channel_log(channel):
       if 'nick' in info:
         nick = info['nick']
         event = info.get('event')
@@ -336,103 +815,165 @@ class IrcLogger(IrcClient):
     return self.whois_data[nick]
 
   def irc_cached_whois(self, nickname, userhost=None):
-    nuh = '%s!%s' % (nickname, userhost)
-    if userhost and nuh in self.whois_cache:
-      return self.whois_cache[nuh]
-    info = {'uid': ''}
-    for nuh in self.whois_cache:
-      n_info = self.whois_cache[nuh]
-      if n_info['uid'] > info['uid']:
-        info = n_info
+    info = self.whois_by_nick.get(nickname.lower())
+    if info and (not userhost or info.get('userhost') == userhost):
+      return info
+    return self.whois_departed.get(userhost) or {'uid': ''}
+
+  def irc_remember_whois(self, info):
+    """Index WHOIS info by nickname."""
+    self.whois_by_nick[info['nick'].lower()] = info
+    if info.get('userhost') in self.whois_departed:
+      del self.whois_departed[info['userhost']]
     return info
 
+  def irc_forget_whois(self, info):
+    """Drop a departed user, but remember their uid by userhost."""
+    low_nick, userhost = info['nick'].lower(), info.get('userhost')
+    if self.whois_by_nick.get(low_nick) is info:
+      del self.whois_by_nick[low_nick]
+    if userhost:
+      self.whois_departed[userhost] = {'uid': info['uid']}
+      while len(self.whois_departed) > self.MAXDEPARTED:
+        self.whois_departed.popitem(last=False)
+
   def irc_update_whois(self, nuh, update={}, depart=None, new_nick=None):
     nickname, userhost = nuh.split('!', 1)
     whois = self.irc_cached_whois(nickname, userhost)
     channels = [c for c in whois.get('channels', []) if c in self.channels]
-    if whois['uid']:
+    if whois['uid'] and 'nick' in whois:
       if new_nick:
+        if self.whois_by_nick.get(nickname.lower()) is whois:
+          del self.whois_by_nick[nickname.lower()]
         whois['nick'] = new_nick
-        self.whois_cache['%s!%s' % (new_nick, userhost)] = whois
-        if nuh in self.whois_cache:
-          del self.whois_cache[nuh]
+        self.irc_remember_whois(whois)
       whois.update(update)
-      if depart and 'channels' in whois:
+      if depart in whois.get('channels', []):
         whois['channels'].remove(depart)
       for channel in channels:
         if whois:
-          self.irc_channel_log_append(channel, [get_timed_uid(), whois])
+          self.irc_channel_log_append(channel, whois)
+      if not [c for c in whois.get('channels', []) if c in self.channels]:
+        self.irc_forget_whois(whois)
     return whois, channels
 
-  def irc_parsed_mode(self, channel):
-    mode_string, log_id, fixme = self.channel_mode.get(channel, ['ns', 0, None])
-    mode_words = mode_string.split(' ')
-    mode = mode_words.pop(0)
-    info = {
-      'event': 'mode',
-      'log_id': log_id,
-      'raw_mode': mode_string
-    }
-    for m in mode:
-      if m == 'a':
-        info['anonymous'] = True
-      elif m == 'b':
-        info['bans'] = info.get('bans', []) + [mode_words.pop(0)]
-      elif m == 'i':
-        info['invite_only'] = True
-      elif m == 'I':
-        info['invite_mask'] = info.get('invite_mask', []) + [mode_words.pop(0)]
-      elif m == 'k':
-        info['key'] = mode_words.pop(0)
-      elif m == 'l':
-        info['limit'] = mode_words.pop(0)
-      elif m == 'm':
-        info['moderated'] = True
-      elif m == 'n':
-        info['must_join'] = True
-      elif m == 'q':
-        info['quiet'] = True
-      elif m == 's':
-        info['secret'] = True
-      elif m == 't':
-        info['topic_locked'] = True
-    return info
+  def irc_whois_done(self, info, channels):
+    """Record complete WHOIS info and log it to the given channels."""
+    nickname = info['nick']
+    if not info.get('uid'):
+      known = self.irc_cached_whois(nickname, info['userhost'])
+      info['uid'] = known.get('uid') or get_timed_uid()
+    self.irc_remember_whois(info)
+
+    # Do we know this user, can we augment with profile data?
+    user = self.irc_find_user(nickname, info['uid'])
+    info.update(self.irc_augment_whois(nickname, user))
+
+    # Write back the log ID
+    if user:
+      user.irc_log_id(info['uid'])
+
+    if nickname.lower() != self.low_nick:
+      for channel in channels:
+        if channel in self.channels:
+          self.irc_channel_log_append(channel, info)
+
+  def irc_who_reply(self, channel, nickname, userhost, flags, realname):
+    """Channel WHO replies tell us enough to skip most WHOIS requests."""
+    low_nick = nickname.lower()
+    self.who_names.get(channel, {}).pop(low_nick, None)
+    self.want_whois_set.discard(low_nick)
+    if low_nick == self.low_nick:
+      return
+    info = self.irc_cached_whois(nickname, userhost)
+    if 'nick' not in info:
+      info = {
+        'event': 'whois',
+        'nick': nickname,
+        'userhost': userhost,
+        'userinfo': realname
+      }
+    if channel not in info.setdefault('channels', []):
+      info['channels'].append(channel)
+    for flag, key in (('@', 'chan_ops'), ('+', 'chan_vops')):
+      if flag in flags and channel not in info.setdefault(key, []):
+        info[key].append(channel)
+    self.irc_whois_done(info, [channel])
+
+  def irc_channel_mode(self, channel):
+    """Return the channel's ChannelMode (secret until we know better)."""
+    return self.channel_mode.get(channel) or ChannelMode()
 
   ### Protocol callbacks follow ###
 
   def on_324(self, parts, write_cb):
     """Channel mode information."""
-    channel, mode = parts[3], parts[4]
-    log_id = get_timed_uid()
-    self.channel_mode[channel] = [mode, log_id, None]
-    self.irc_channel_log_append(channel,
-                                [log_id, self.irc_parsed_mode(channel)])
+    channel = parts[3]
+    log_id = self.irc_channel_log(channel).next_seq
+    mode = ChannelMode({}).changed(parts[4], parts[5:], log_id, strict=False)
+    self.channel_mode[channel] = mode
+    self.irc_channel_log_append(channel, mode.info)
 
   def on_mode(self, parts, write_cb):
     by_nuh, channel, mode = parts[0], parts[2], parts[3]
     if '!' in by_nuh:
       nickname, userhost = by_nuh.split('!', 1)
-      self.irc_channel_log_append(channel, [get_timed_uid(), {
+      self.irc_channel_log_append(channel, {
         'event': 'mode',
         'mode': mode,
         'nick': nickname,
         'uid': self.irc_cached_whois(nickname, userhost).get('uid')
-      }])
-      write_cb('MODE %s\r\n' % channel)
+      })
+      old_mode, new_mode = self.channel_mode.get(channel), None
+      if old_mode:
+        new_mode = old_mode.changed(mode, parts[4:],
+                                    self.irc_channel_log(channel).next_seq)
+      if new_mode is None:
+        # Not something we can track, ask the server what happened.
+        write_cb('MODE %s\r\n' % channel)
+      elif new_mode.modes != old_mode.modes:
+        self.channel_mode[channel] = new_mode
+        self.irc_channel_log_append(channel, new_mode.info)
     else:
       return IrcClient.on_mode(self, parts, write_cb)
 
+  def on_005(self, parts, write_cb):
+    """Limits and features, we care whether WHOX is supported."""
+    if 'WHOX' in parts[3:]:
+      self.isupport_whox = True
+
   def on_353(self, parts, write_cb):
     """We want more info about anyone listed in /NAMES."""
-    self.want_whois.extend(parts[5].replace('@', '')
-                                   .replace('+', '').split())
+    names = self.who_names.setdefault(parts[4], {})
+    for nick in parts[5].split():
+      nick = nick.lstrip('~&@%+')
+      names[nick.lower()] = nick
 
   def on_366(self, parts, write_cb):
-    """On end of /NAMES, run /MODE and /WHOIS to gather channel info."""
+    """On end of /NAMES, run /MODE and /WHO to gather channel info."""
     channel = parts[3]
     write_cb('MODE %s\r\n' % channel)
-    if self.want_whois:
-      self.irc_whois(self.want_whois.pop(0), write_cb)
+    if self.isupport_whox:
+      write_cb('WHO %s %%tcuhnfr,%s\r\n' % (channel, self.WHOX_TOKEN))
+    else:
+      write_cb('WHO %s\r\n' % channel)
+
+  def on_352(self, parts, write_cb):
+    """WHO reply: channel, user, host, server, nick, flags, hops+name."""
+    self.irc_who_reply(parts[3], parts[7], '@'.join(parts[4:6]), parts[8],
+                       parts[9].split(' ', 1)[-1])
+
+  def on_354(self, parts, write_cb):
+    """WHOX reply: token, channel, user, host, nick, flags, name."""
+    if parts[3] == self.WHOX_TOKEN:
+      self.irc_who_reply(parts[4], parts[7], '@'.join(parts[5:7]), parts[8],
+                         parts[9])
+
+  def on_315(self, parts, write_cb):
+    """End of /WHO, fall back to /WHOIS for anyone it did not cover."""
+    for nick in self.who_names.pop(parts[3], {}).values():
+      self.irc_want_whois(nick)
+    self.irc_whois_pump(write_cb)
 
   def on_311(self, parts, write_cb):
     self.irc_whois_info(parts[3]).update({
@@ -457,27 +998,27 @@ class IrcLogger(IrcClient):
     nickname = parts[3]
     info = self.irc_whois_info(nickname)
     del self.whois_data[nickname]
-
-    nuh = '%s!%s' % (nickname, info['userhost'])
-    new_uid = get_timed_uid()
-    info['uid'] = self.whois_cache.get(nuh, {}).get('uid', new_uid)
-    self.whois_cache[nuh] = info
-
-    # Do we know this user, can we augment with profile data?
-    user = self.irc_find_user(nickname, info['uid'])
-    info.update(self.irc_augment_whois(nickname, user))
-
-    # Write back the log ID
-    if user:
-      user.log_id = info['uid']
-
-    if nickname.lower() != self.low_nick:
-      for channel in info.get('channels', []):
-        if channel in self.channels:
-          self.irc_channel_log_append(channel, [new_uid, info])
-
-    if self.want_whois:
-      self.irc_whois(self.want_whois.pop(0), write_cb)
+    self.whois_pending.pop(nickname.lower(), None)
+    self.want_whois_set.discard(nickname.lower())
+    if 'userhost' in info:
+      self.irc_whois_done(info, info.get('channels', []))
+    self.irc_whois_pump(write_cb)
+
+  def on_401(self, parts, write_cb):
+    """No such nick: whoever we asked about is gone."""
+    self.whois_pending.pop(parts[3].lower(), None)
+    self.irc_whois_pump(write_cb)
+
+  on_402 = on_401
+
+  def on_263(self, parts, write_cb):
+    """Server says try again later: requeue the oldest WHOIS, slow down."""
+    if parts[3].upper() == 'WHOIS' and self.whois_pending:
+      low_nick = min(self.whois_pending, key=self.whois_pending.get)
+      del self.whois_pending[low_nick]
+      self.irc_want_whois(low_nick)
+      self.whois_tokens = 0
+    self.irc_whois_pump(write_cb)
 
   def on_332(self, parts, write_cb):
     """Channel topic."""
@@ -488,11 +1029,11 @@ class IrcLogger(IrcClient):
     }
     log = self.irc_channel_log(channel);
     if log:
-      last_id, last = log[-1]
+      last_id, last = log[-1][:2]
       if last.get('event') == 'topic' and not last.get('text'):
         info.update(last)
         info['update'] = last_id
-    self.irc_channel_log_append(channel, [get_timed_uid(), info])
+    self.irc_channel_log_append(channel, info)
 
   def on_333(self, parts, write_cb):
     """Channel topic metadata."""
@@ -505,74 +1046,81 @@ class IrcLogger(IrcClient):
     }
     log = self.irc_channel_log(channel);
     if log:
-      last_id, last = log[-1]
+      last_id, last = log[-1][:2]
       if last.get('event') == 'topic' and not last.get('nick'):
         info.update(last)
         info['update'] = last_id
-    self.irc_channel_log_append(channel, [get_timed_uid(), info])
+    self.irc_channel_log_append(channel, info)
 
   def on_join(self, parts, write_cb):
     nickname, userhost = parts[0].split('!', 1)
     if nickname.lower() != self.low_nick:
-      self.irc_channel_log_append(parts[2], [get_timed_uid(), {
+      self.irc_channel_log_append(parts[2], {
         'event': 'join',
         'nick': nickname,
         'uid': self.irc_cached_whois(nickname, userhost).get('uid')
-      }])
-      self.irc_whois(nickname, write_cb)
+      })
+      self.irc_want_whois(nickname, urgent=True)
+      self.irc_whois_pump(write_cb)
 
   def on_nick(self, parts, write_cb):
+    IrcClient.on_nick(self, parts, write_cb)
     nuh, new_nick = parts[0], parts[2]
     nickname, userhost = nuh.split('!', 1)
     whois, channels = self.irc_update_whois(nuh, new_nick=new_nick)
     for channel in channels:
-      self.irc_channel_log_append(channel, [get_timed_uid(), {
+      self.irc_channel_log_append(channel, {
         'event': 'nick',
         'nick': nickname,
         'text': new_nick,
         'uid': whois.get('uid')
-      }])
+      })
 
   def on_part(self, parts, write_cb):
     nuh, channel = parts[0], parts[2]
     nickname, userhost = nuh.split('!', 1)
     whois, channels = self.irc_update_whois(nuh, depart=channel)
-    self.irc_channel_log_append(channel, [get_timed_uid(), {
+    self.irc_channel_log_append(channel, {
       'event': 'part',
       'nick': nickname,
-      'uid': self.irc_cached_whois(nickname, userhost).get('uid')
-    }])
+      'uid': whois.get('uid')
+    })
 
   def on_privmsg_channel(self, parts, write_cb):
     nickname, userhost = parts[0].split('!', 1)
     msg_type, text = self.irc_decode_message(parts[3])
-    self.irc_channel_log_append(parts[2], [get_timed_uid(), {
+    uid = self.irc_cached_whois(nickname, userhost).get('uid')
+    self.irc_channel_log_append(parts[2], {
       'event': msg_type,
       'text': text,
       'nick': nickname,
-      'uid': self.irc_cached_whois(nickname, userhost).get('uid')
-    }])
+      'uid': uid
+    })
+    if not uid:
+      # Find out who is talking before anyone else.
+      self.irc_want_whois(nickname, urgent=True)
+      self.irc_whois_pump(write_cb)
 
   def on_quit(self, parts, write_cb):
     nuh, quit_msg = parts[0], parts[2]
     nickname, userhost = nuh.split('!', 1)
     whois, channels = self.irc_update_whois(nuh, update={'channels': []})
     for channel in channels:
-      self.irc_channel_log_append(channel, [get_timed_uid(), {
+      self.irc_channel_log_append(channel, {
         'event': 'quit',
         'nick': nickname,
         'text': quit_msg,
         'uid': whois.get('uid')
-      }])
+      })
 
   def on_topic(self, parts, write_cb):
     nickname, userhost = parts[0].split('!', 1)
-    self.irc_channel_log_append(parts[2], [get_timed_uid(), {
+    self.irc_channel_log_append(parts[2], {
       'event': 'topic',
       'text': parts[3],
       'nick': nickname,
       'uid': self.irc_cached_whois(nickname, userhost).get('uid')
-    }])
+    })
 
 
 
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+#
+# Mutiny.py, Copyright 2012, Bjarni R. Einarsson <http://bre.klaki.net/>
+#
+# This is an IRC-to-WWW gateway designed to help Pirates have Meetings.
+#
+################################################################################
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the  GNU  Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,  but  WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see: <http://www.gnu.org/licenses/>
+#
+################################################################################
+#
+# Python standard
+import mmap
+import os
+import struct
+import threading
+import traceback
+import urllib
+import Queue
+from collections import OrderedDict
+# Stuff from Mutiny
+from mutiny.search import ChannelIndex
+
+
+class ChannelJournal:
+  """The on-disk log of one channel: a directory of append-only segments.
+
+  Each segment is named after the first sequence number it holds, and
+  contains one JSON log entry per line. Next to it is a sparse index of
+  (seq, offset) pairs, one for every INDEX_EVERY entries."""
+
+  SEGMENT_BYTES = 4 * 1024 * 1024
+  SEGMENT_SECONDS = 24 * 3600
+  INDEX_EVERY = 64
+  INDEX_FORMAT = '>QQ'
+  INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+  MAPPED = 8
+
+  def __init__(self, path):
+    self.path = path
+    self.maps = OrderedDict()
+    self.maps_lock = threading.Lock()
+    self.search = None
+    self.fd = self.index_fd = None
+    self.size = self.entries = self.started = 0
+    self.last_seq = 0
+    if not os.path.exists(path):
+      os.makedirs(path)
+    segments = self.segments()
+    if segments:
+      self.reopen(segments[-1])
+
+  def segments(self):
+    """Return the first sequence numbers of all segments, in order."""
+    return sorted(int(fn[:-6]) for fn in os.listdir(self.path)
+                                if fn.endswith('.jsonl'))
+
+  def segment_path(self, first_seq, ext='jsonl'):
+    return os.path.join(self.path, '%12.12d.%s' % (first_seq, ext))
+
+  def reopen(self, first_seq):
+    """Continue the newest segment, dropping any half-written last line."""
+    fn = self.segment_path(first_seq)
+    fd = open(fn, 'rb')
+    data = fd.read()
+    fd.close()
+    if data and not data.endswith('\n'):
+      data = data[:data.rfind('\n') + 1]
+      fd = open(fn, 'r+b')
+      fd.truncate(len(data))
+      fd.close()
+    lines = data.splitlines()
+    if lines:
+      self.started = int(lines[0].rsplit(',', 1)[1].rstrip(']'))
+      self.last_seq = int(lines[-1][1:].split(',', 1)[0])
+    self.size = len(data)
+    self.entries = len(lines)
+    self.fd = open(fn, 'ab')
+    self.index_fd = open(self.segment_path(first_seq, 'idx'), 'ab')
+
+  def tail(self, count):
+    """Return the last count entries as JSON lines, oldest first."""
+    lines = []
+    for first_seq in reversed(self.segments()):
+      if len(lines) >= count:
+        break
+      fd = open(self.segment_path(first_seq), 'rb')
+      lines[:0] = [l for l in fd.read().splitlines() if l.endswith(']')]
+      fd.close()
+    return lines[-count:]
+
+  def rotate(self, seq, ts):
+    self.close_segment()
+    self.fd = open(self.segment_path(seq), 'ab')
+    self.index_fd = open(self.segment_path(seq, 'idx'), 'ab')
+    self.size = self.entries = 0
+    self.started = ts
+
+  def write(self, seq, ts, line):
+    if seq <= self.last_seq:
+      print 'Journal %s: dropped %d, already at %d' % (self.path, seq,
+                                                       self.last_seq)
+      return
+    if (self.fd is None or
+        self.size >= self.SEGMENT_BYTES or
+        ts - self.started >= self.SEGMENT_SECONDS):
+      self.rotate(seq, ts)
+    if self.entries % self.INDEX_EVERY == 0:
+      self.index_fd.write(struct.pack(self.INDEX_FORMAT, seq, self.size))
+    self.fd.write(line + '\n')
+    self.size += len(line) + 1
+    self.entries += 1
+    self.last_seq = seq
+    if self.search is not None:
+      self.search.add(seq, line)
+
+  def mapped(self, first_seq, ext='jsonl'):
+    """Return a read-only map of a segment's complete lines (or index)."""
+    fn = self.segment_path(first_seq, ext)
+    try:
+      size = os.path.getsize(fn)
+    except OSError:
+      return ''
+    key = (first_seq, ext)
+    self.maps_lock.acquire()
+    try:
+      data = self.maps.pop(key, None)
+      if data is None or len(data) != size:
+        data = ''
+        if size:
+          fd = open(fn, 'rb')
+          data = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+          fd.close()
+      # Old maps are not closed, a reader may still be using them.
+      self.maps[key] = data
+      while len(self.maps) > self.MAPPED:
+        self.maps.popitem(last=False)
+      return data
+    finally:
+      self.maps_lock.release()
+
+  def seek(self, first_seq, seq):
+    """Return the offset of an indexed entry at or before seq."""
+    index = self.mapped(first_seq, 'idx')
+    lo, hi, offset = 0, len(index) // self.INDEX_SIZE, 0
+    while lo < hi:
+      mid = (lo + hi) // 2
+      iseq, ioff = struct.unpack_from(self.INDEX_FORMAT, index,
+                                      mid * self.INDEX_SIZE)
+      if iseq <= seq:
+        lo, offset = mid + 1, ioff
+      else:
+        hi = mid
+    return offset
+
+  def read(self, first, last, match=lambda line: True):
+    """Return the JSON lines of entries first to last (inclusive).
+
+    Only the segments and the bit of index needed are looked at, so
+    paging through old history costs the same no matter how much of it
+    there is."""
+    return [line for seq, line in self.entries_between(first, last)
+                 if match(line)]
+
+  def entries_between(self, first, last):
+    """Generate (seq, line) for entries first to last, one at a time."""
+    segments = self.segments()
+    start = 0
+    for i, first_seq in enumerate(segments):
+      if first_seq <= first:
+        start = i
+    for first_seq in segments[start:]:
+      if first_seq > last:
+        break
+      data = self.mapped(first_seq)
+      end = data.rfind('\n') + 1 if data else 0
+      pos = self.seek(first_seq, first)
+      while pos < end:
+        eol = data.find('\n', pos)
+        line = data[pos:eol]
+        pos = eol + 1
+        seq = int(line[1:line.index(',')])
+        if seq > last:
+          return
+        if seq >= first:
+          yield seq, line
+
+  def sync(self):
+    if self.fd is not None:
+      self.fd.flush()
+      self.index_fd.flush()
+      os.fsync(self.fd.fileno())
+    if self.search is not None:
+      # No fsync, this can be rebuilt from the journal.
+      self.search.sync()
+
+  def close_segment(self):
+    if self.fd is not None:
+      self.sync()
+      self.fd.close()
+      self.index_fd.close()
+      self.fd = self.index_fd = None
+
+  def close(self):
+    self.close_segment()
+    if self.search is not None:
+      self.search.sync()
+      self.search.close()
+
+
+class Journal(threading.Thread):
+  """Permanent channel logs, written to disk by a background thread.
+
+  Appends are queued, the writer takes everything that is waiting as one
+  batch and fsyncs each channel once per batch. Given a Tokenizer, the
+  writer also keeps a search index for each channel.
+
+  Other slow work on the journals can be queued with call(), it runs on
+  the writer thread in order with the appends."""
+
+  BATCH = 1000
+
+  def __init__(self, path, tokenizer=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.path = path
+    self.tokenizer = tokenizer
+    self.queue = Queue.Queue()
+    self.channels = {}
+    self.channels_lock = threading.Lock()
+
+  def channel(self, network, channel):
+    """Return the ChannelJournal for a channel, opening it if necessary."""
+    key = (network, channel)
+    self.channels_lock.acquire()
+    try:
+      if key not in self.channels:
+        journal = ChannelJournal(os.path.join(self.path,
+                                              urllib.quote(network, ''),
+                                              urllib.quote(channel, '')))
+        if self.tokenizer is not None:
+          self.call(self.attach_index, journal)
+        self.channels[key] = journal
+      return self.channels[key]
+    finally:
+      self.channels_lock.release()
+
+  def attach_index(self, journal):
+    """Load a channel's search index and catch up with the journal.
+
+    This runs on the writer thread, so nothing is written to the journal
+    meanwhile and the index does not miss anything."""
+    index = ChannelIndex(journal.path, self.tokenizer)
+    index.catch_up(journal)
+    journal.search = index
+
+  def append(self, network, channel, seq, ts, line):
+    """Queue an entry for writing, this never blocks."""
+    self.queue.put((network, channel, seq, ts, line))
+
+  def call(self, callback, *args):
+    """Queue callback(*args) to run on the writer thread."""
+    self.queue.put((callback, args))
+
+  def stop(self):
+    self.queue.put(None)
+    if self.isAlive():
+      self.join()
+
+  def run(self):
+    running = True
+    while running:
+      batch = [self.queue.get()]
+      try:
+        while len(batch) < self.BATCH:
+          batch.append(self.queue.get_nowait())
+      except Queue.Empty:
+        pass
+      dirty = set()
+      for item in batch:
+        if item is None:
+          running = False
+          continue
+        if len(item) == 2:
+          callback, args = item
+          try:
+            callback(*args)
+          except:
+            print '%s' % traceback.format_exc()
+          continue
+        network, channel, seq, ts, line = item
+        try:
+          journal = self.channel(network, channel)
+          journal.write(seq, ts, line)
+          dirty.add(journal)
+        except (IOError, OSError):
+          print '%s' % traceback.format_exc()
+      for journal in dirty:
+        try:
+          journal.sync()
+        except (IOError, OSError):
+          print '%s' % traceback.format_exc()
+    for journal in self.channels.values():
+      journal.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Mutiny.py, Copyright 2012, Bjarni R. Einarsson <http://bre.klaki.net/>
+#
+# This is an IRC-to-WWW gateway designed to help Pirates have Meetings.
+#
+################################################################################
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the  GNU  Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,  but  WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see: <http://www.gnu.org/licenses/>
+#
+################################################################################
+#
+# Python standard
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from array import array
+
+
+class Tokenizer:
+  """Split text into case-folded search terms.
+
+  Characters are first mapped using (source, destination) tables like
+  Mutiny.TRANSLATE, so searching for 'thjod' also finds
+  the accented Icelandic spelling."""
+
+  WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+  def __init__(self, translate=[]):
+    self.table = {}
+    for src, dst in translate:
+      for c, d in zip(src, dst):
+        self.table[ord(c)] = unicode(d)
+
+  def terms(self, text):
+    if isinstance(text, str):
+      text = text.decode('utf-8', 'replace')
+    return set(self.WORD_RE.findall(text.translate(self.table).lower()))
+
+  def entry_terms(self, info):
+    """Return the terms a log entry should be found by."""
+    if not isinstance(info, dict):
+      return set()
+    return self.terms(u'%s %s' % (info.get('nick', ''), info.get('text', '')))
+
+
+class ChannelIndex:
+  """An inverted index (term -> seqs) over one channel's journal.
+
+  The terms of each entry are appended to a file next to the journal
+  segments, which is read back on startup. The journal remains the
+  authority: anything missing from the terms file is indexed again."""
+
+  FILENAME = 'search.terms'
+
+  def __init__(self, path, tokenizer):
+    self.path = os.path.join(path, self.FILENAME)
+    self.tokenizer = tokenizer
+    self.postings = {}
+    self.lock = threading.Lock()
+    self.count = 0
+    self.last_seq = 0
+    self.load()
+    self.fd = open(self.path, 'ab')
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return
+    fd = open(self.path, 'rb')
+    data = fd.read()
+    fd.close()
+    if data and not data.endswith('\n'):
+      data = data[:data.rfind('\n') + 1]
+      fd = open(self.path, 'r+b')
+      fd.truncate(len(data))
+      fd.close()
+    for line in data.splitlines():
+      terms = line.decode('utf-8').split(' ')
+      self.insert(int(terms[0]), terms[1:])
+
+  def insert(self, seq, terms):
+    postings = self.postings
+    for term in terms:
+      if term not in postings:
+        postings[term] = array('L', [seq])
+      else:
+        postings[term].append(seq)
+    self.count += 1
+    self.last_seq = seq
+
+  def add(self, seq, line):
+    """Index a JSON log entry, as written to the journal."""
+    if seq <= self.last_seq:
+      return
+    terms = sorted(self.tokenizer.entry_terms(json.loads(line)[1]))
+    self.fd.write(('%d %s\n' % (seq, ' '.join(terms))).encode('utf-8'))
+    self.lock.acquire()
+    try:
+      self.insert(seq, terms)
+    finally:
+      self.lock.release()
+
+  def catch_up(self, journal):
+    """Index whatever the journal has which we do not."""
+    if journal.last_seq > self.last_seq:
+      for seq, line in journal.entries_between(self.last_seq + 1,
+                                               journal.last_seq):
+        self.add(seq, line)
+      self.sync()
+
+  def search(self, query, limit=20, offset=0):
+    """Return (score, seq) pairs, best first.
+
+    Entries score the inverse document frequency of each query term
+    they contain, so rare words count for more. Ties go to newer ones."""
+    scores = {}
+    self.lock.acquire()
+    try:
+      for term in self.tokenizer.terms(query):
+        seqs = self.postings.get(term)
+        if seqs:
+          idf = math.log(1.0 + float(self.count) / len(seqs))
+          for seq in seqs:
+            scores[seq] = scores.get(seq, 0.0) + idf
+    finally:
+      self.lock.release()
+    best = heapq.nlargest(offset + limit, scores.iteritems(),
+                          key=lambda (seq, score): (score, seq))
+    return [(score, seq) for seq, score in best[offset:]]
+
+  def sync(self):
+    self.fd.flush()
+
+  def close(self):
+    self.fd.close()
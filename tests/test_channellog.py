@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Mutiny.py, Copyright 2012, Bjarni R. Einarsson <http://bre.klaki.net/>
+#
+# This is an IRC-to-WWW gateway designed to help Pirates have Meetings.
+#
+################################################################################
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the  GNU  Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,  but  WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see: <http://www.gnu.org/licenses/>
+#
+################################################################################
+#
+# Python standard
+import json
+import threading
+import unittest
+# Stuff from Mutiny
+from mutiny.irc import ChannelLog
+
+
+class ChannelLogResizeTest(unittest.TestCase):
+
+  def make(self, capacity, entries):
+    log = ChannelLog(capacity)
+    for i in range(entries):
+      log.append({'text': 'line %d' % i}, ts=1000 + i)
+    return log
+
+  def check(self, log, first, last):
+    seqs = range(first, last + 1)
+    self.assertEqual(len(log), len(seqs))
+    self.assertEqual([e[0] for e in log], seqs)
+    self.assertEqual([e[0] for e in json.loads(log.json_after(0))], seqs)
+    self.assertEqual([s for s, line in log.json_entries_after(0)], seqs)
+    for seq, line in log.json_entries_after(0):
+      self.assertEqual(json.loads(line)[0], seq)
+    self.assertEqual([e[0] for e in log.after(first + 1)], seqs[2:])
+    log.append({'text': 'after resize'})
+    self.assertEqual(log[-1][0], last + 1)
+    self.assertEqual(json.loads(log.json_after(last))[0][0], last + 1)
+
+  def test_partly_full(self):
+    for capacity in (200, 300, 150, 100, 30):
+      log = self.make(300, 150)
+      log.resize(capacity)
+      self.check(log, max(1, 151 - capacity), 150)
+
+  def test_wrapped(self):
+    for capacity in (200, 100, 70, 40):
+      log = self.make(100, 250)
+      log.resize(capacity)
+      self.check(log, 251 - min(capacity, 100), 250)
+
+  def test_same_size(self):
+    log = self.make(100, 60)
+    log.resize(100)
+    self.check(log, 1, 60)
+    log = self.make(100, 160)
+    log.resize(100)
+    self.check(log, 61, 160)
+
+
+
+class ChannelLogRestoreTest(unittest.TestCase):
+
+  def lines(self, seqs):
+    return [json.dumps([seq, {'text': 'old %d' % seq}, 1000 + seq])
+            for seq in seqs]
+
+  def test_continues_journal(self):
+    log = ChannelLog(10).restore(self.lines(range(1, 31)), 30)
+    self.assertEqual([e[0] for e in log], range(21, 31))
+    self.assertEqual(log.append({'text': 'new'}), 31)
+    self.assertEqual([e[0] for e in log.after(25)], range(26, 32))
+
+  def test_gaps_are_not_restored(self):
+    log = ChannelLog(10).restore(self.lines([1, 2, 3, 7, 8, 9]), 9)
+    self.assertEqual([e[0] for e in log], [7, 8, 9])
+    self.assertEqual([e[0] for e in log.after(7)], [8, 9])
+
+  def test_tail_behind_journal(self):
+    log = ChannelLog(10).restore(self.lines([1, 2, 3]), 5)
+    self.assertEqual(len(log), 0)
+    self.assertEqual(log.append({'text': 'new'}), 6)
+
+  def test_live_log_is_refused(self):
+    log = ChannelLog(10)
+    log.append({'text': 'live'})
+    self.assertRaises(ValueError, log.restore, self.lines([1, 2]), 2)
+
+
+
+class ChannelLogThreadTest(unittest.TestCase):
+
+  def test_reads_during_appends(self):
+    log = ChannelLog(50)
+    done, bad = [], []
+    def append():
+      for i in range(20000):
+        log.append({'text': 'line %d' % i})
+      done.append(True)
+    writer = threading.Thread(target=append)
+    writer.start()
+    while not done:
+      seqs = [e[0] for e in json.loads(log.json_after(0))]
+      if seqs and seqs != range(seqs[0], seqs[0] + len(seqs)):
+        bad.append(seqs)
+      for seq, line in log.json_entries_after(0):
+        if json.loads(line)[0] != seq:
+          bad.append((seq, line))
+    writer.join()
+    self.assertEqual(bad, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
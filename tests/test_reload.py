@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Mutiny.py, Copyright 2012, Bjarni R. Einarsson <http://bre.klaki.net/>
+#
+# This is an IRC-to-WWW gateway designed to help Pirates have Meetings.
+#
+################################################################################
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the  GNU  Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,  but  WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see: <http://www.gnu.org/licenses/>
+#
+################################################################################
+#
+# Python standard
+import copy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+# Stuff from Mutiny
+from mutiny.app import Mutiny
+from mutiny.journal import Journal
+
+
+class ReloadJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.config = {
+      'work_dir': self.work_dir,
+      'http_host': 'localhost',
+      'http_port': 1,
+      'journal': True,
+      'irc': {'net': {'enable': 1, 'nickname': 'bot', 'servers': [],
+                      'channels': {'#a': {'maxlines': 20}}}}
+    }
+    self.mutiny = None
+
+  def tearDown(self):
+    if self.mutiny is not None:
+      self.mutiny.stop()
+    shutil.rmtree(self.work_dir)
+
+  def start(self):
+    self.mutiny = Mutiny(copy.deepcopy(self.config))
+    self.mutiny.connect_client = lambda *args: None
+    self.mutiny.start()
+    self.settle()
+    return self.mutiny.networks['net']
+
+  def on_loop(self, callback, *args):
+    done = threading.Event()
+    def run():
+      try:
+        callback(*args)
+      finally:
+        done.set()
+    self.mutiny.event_loop.call_soon(run)
+    self.assertTrue(done.wait(5))
+
+  def settle(self):
+    """Wait for queued journal work and what it hands back to the loop."""
+    done = threading.Event()
+    self.mutiny.after_journal(done.set)
+    self.assertTrue(done.wait(5))
+    self.on_loop(lambda: None)
+
+  def say(self, bot, count):
+    def log():
+      for i in range(count):
+        bot.irc_channel_log_append('#a', {'event': 'privmsg', 'text': 'x'})
+    self.on_loop(log)
+
+  def set_log(self, enabled):
+    self.config['irc']['net']['channels']['#a']['log'] = enabled
+    self.on_loop(self.mutiny.reload, copy.deepcopy(self.config))
+    self.settle()
+
+  def journaled(self):
+    done = threading.Event()
+    self.mutiny.journal.call(done.set)
+    self.assertTrue(done.wait(5))
+    cj = self.mutiny.journal.channel('net', '#a')
+    return [json.loads(line)[0] for line in cj.read(1, cj.last_seq)]
+
+  def seqs(self, bot):
+    return [entry[0] for entry in bot.irc_channel_log('#a')]
+
+  def test_toggle_log(self):
+    bot = self.start()
+    self.say(bot, 5)
+    self.set_log(False)
+    self.assertFalse(self.mutiny.is_recording('net', '#a'))
+    self.say(bot, 5)
+    self.set_log(True)
+    self.assertTrue(self.mutiny.is_recording('net', '#a'))
+    self.say(bot, 5)
+    self.assertEqual(self.seqs(bot), range(1, 16))
+    self.assertEqual(self.journaled(), range(1, 6) + range(11, 16))
+
+  def test_restart_continues_journal(self):
+    bot = self.start()
+    self.say(bot, 25)
+    self.mutiny.stop()
+    bot = self.start()
+    self.assertEqual(self.seqs(bot), range(6, 26))
+    self.say(bot, 1)
+    self.assertEqual(self.journaled(), range(1, 27))
+
+  def test_enable_behind_journal(self):
+    journal = Journal(os.path.join(self.work_dir, 'logs'))
+    journal.start()
+    for seq in range(1, 51):
+      journal.append('net', '#a', seq, 1000 + seq,
+                     json.dumps([seq, {'text': 'old'}, 1000 + seq]))
+    journal.stop()
+    self.config['irc']['net']['channels']['#a']['log'] = False
+    bot = self.start()
+    self.say(bot, 5)
+    self.set_log(True)
+    # The live log is numbered below the journal, so it is not attached.
+    self.assertFalse(self.mutiny.is_recording('net', '#a'))
+    self.say(bot, 5)
+    self.assertEqual(self.seqs(bot), range(1, 11))
+    self.assertEqual(self.journaled(), range(1, 51))
+
+
+if __name__ == '__main__':
+  unittest.main()